@@ -0,0 +1,267 @@
+"""
+Created on 10/17/2026
+An asyncio version of the domain operations in CommonUtilities.py and main.py, on top of Motor,
+so that one process can have many order entry clients in flight at once.  MongoEngine itself is
+synchronous, so the Document classes are only used here to build and validate the documents and
+to supply the column names, the uniqueness constraints, and the same filters and error messages
+as the synchronous code.  Every read and write goes through Motor.
+
+    data = AsyncDataAccess.connect('mongodb://localhost:27017', 'one_to_many')
+    order = await data.create_order(Order('Jane Customer', datetime.utcnow(), 'Joe Clerk'))
+    await data.add_item(order, product, 2)
+    await data.change_status(order.pk, StatusChange(Status.SHIPPED, datetime.utcnow()))
+
+The uniqueness constraints come out of the same cache as the synchronous code, so call
+load_index_cache (Utilities.startup does) before using this.
+"""
+import asyncio
+
+from mongoengine import NotUniqueError
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from CascadeUtilities import DeleteReport, supports_transactions, cascade_classes, item_quantities
+from DocumentCache import invalidate, cached_columns_changed
+from ConstraintUtilities import uniqueness_query, violations, duplicate_key_constraints
+from Order import Order
+from OrderItem import OrderItem
+from PriceHistory import PriceHistory
+from PriceHistoryBucket import PriceHistoryBucket
+from Product import Product
+from ReferenceUtilities import forget_change, reference_ids
+from StatusChange import StatusChange
+from StatusHistoryBucket import StatusHistoryBucket
+
+
+class AsyncDataAccess:
+    """The domain operations on orders, products and order items, as coroutines."""
+
+    def __init__(self, database):
+        """
+        :param database:    The Motor database (AsyncIOMotorDatabase) to work in.
+        """
+        self.database = database
+        self.client = database.client
+
+    @staticmethod
+    def connect(uri: str, database: str, **options):
+        """
+        :param uri:         The MongoDB connection string.
+        :param database:    The name of the database.
+        :param options:     Any other MongoClient options, like maxPoolSize.
+        :return:            An AsyncDataAccess on a new Motor client.
+        """
+        return AsyncDataAccess(AsyncIOMotorClient(uri, **options)[database])
+
+    def collection(self, cls):
+        """
+        :param cls: The MongoEngine Document class.
+        :return:    The Motor collection behind that class.
+        """
+        return self.database[cls._get_collection_name()]
+
+    async def supports_transactions(self) -> bool:
+        """
+        supports_transactions for Motor.  Until the client has selected a server for the first time,
+        its topology is Unknown, which would look like a deployment without transactions, so ping
+        the server first in that case.
+        :return:    True if we can start a transaction on this deployment.
+        """
+        if self.client.topology_description.topology_type_name == 'Unknown':
+            await self.client.admin.command('ping')
+        return supports_transactions(self.client)
+
+    async def unique_violations(self, instance) -> list:
+        """
+        The same check as unique_general: every uniqueness constraint in one $or query.
+        :param instance:    The MongoEngine Document instance to check.
+        :return:            A list of the 0 or more {'name', 'columns'} constraints that it violates.
+        """
+        constraints, query, projection = uniqueness_query(instance)
+        if query is None:
+            return []
+        found = await self.collection(type(instance)).find(query, projection).to_list(length=None)
+        return violations(constraints, found)
+
+    async def insert(self, instance):
+        """
+        insert_unique for Motor: validate a new document and insert it straight away, letting the
+        unique indexes catch a duplicate.
+        :param instance:        The unsaved MongoEngine Document instance.  Its pk is set afterwards.
+        :return:                The instance.
+        :raises ValidationError:    If it breaks a rule on the class.
+        :raises NotUniqueError:     If it duplicates a document already in the collection.
+        """
+        instance.validate()
+        try:
+            result = await self.collection(type(instance)).insert_one(instance.to_mongo())
+        except DuplicateKeyError as e:
+            violated = duplicate_key_constraints(type(instance), e.details) or \
+                await self.unique_violations(instance)
+            raise NotUniqueError(f'{type(instance).__name__} violates the uniqueness constraint(s): ' +
+                                 ', '.join(constraint['name'] for constraint in violated)) from e
+        instance.pk = result.inserted_id
+        instance._created = False
+        instance._clear_changed_fields()
+        return instance
+
+    async def create_order(self, order: Order) -> Order:
+        return await self.insert(order)
+
+    async def create_product(self, product: Product) -> Product:
+        return await self.insert(product)
+
+    async def create_orders(self, orders: [Order]) -> list:
+        """
+        Create many orders at once, concurrently.
+        :param orders:  The unsaved Order instances.
+        :return:        For each order, in order, either the saved Order or the exception it raised.
+        """
+        return await asyncio.gather(*[self.create_order(order) for order in orders], return_exceptions=True)
+
+    async def add_item(self, order: Order, product: Product, quantity: int) -> OrderItem:
+        """
+        Put a product on an order: take the stock, insert the OrderItem, then add it to the
+        orderItems of both parents, with the two $addToSet updates running at the same time.
+        :param order:       The (saved) Order.
+        :param product:     The (saved) Product.
+        :param quantity:    How many of the product, at least 1.
+        :return:            The new OrderItem.
+        :raises ValueError: If there is not enough stock.
+        """
+        item = OrderItem(order, product, quantity)
+        item.validate()
+        # Take the stock first, with the same conditional $inc as Product.reserve_stock.
+        reserved = await self.collection(Product).update_one(*Product.stock_reservation(product.pk, quantity))
+        if reserved.matched_count == 0:
+            raise ValueError(f'There are not {quantity} of that product in stock.')
+        try:
+            await self.insert(item)
+        except Exception:
+            await self.collection(Product).bulk_write(Product.stock_release_requests({product.pk: quantity}))
+            raise
+        await asyncio.gather(*[
+            self.collection(type(parent)).update_one(
+                {'_id': parent.pk}, {'$addToSet': {type(parent)._fields['orderItems'].db_field: item.pk}})
+            for parent in (order, product)])
+        for parent in (order, product):
+            parent.add_item(item)
+            forget_change(parent, 'orderItems')
+        return item
+
+    async def push_history(self, owner_cls, bucket_cls, query: dict, update: dict, window: int) -> bool:
+        """
+        HistoryBucket.push for Motor: append one history entry, then archive whatever no longer
+        fits in the window before trimming it off the front.
+        :return:    True if the document matched the query and got the new entry.
+        """
+        collection = self.collection(owner_cls)
+        if not window:
+            return (await collection.update_one(query, update)).matched_count > 0
+        history = next(iter(update['$push']))
+        after = await collection.find_one_and_update(query, update, projection={history: 1},
+                                                     return_document=ReturnDocument.AFTER)
+        if after is None:
+            return False
+        spilled = bucket_cls.spilled(after, history, window)
+        if len(spilled) > 0:
+            await self.collection(bucket_cls).bulk_write(bucket_cls.archive_requests(after['_id'], spilled),
+                                                         ordered=True)
+            await collection.update_one(*bucket_cls.trim(after['_id'], history, spilled))
+        return True
+
+    async def change_status(self, order_id, new_status: StatusChange):
+        """
+        Order.push_status for Motor, with the same rules and the same error messages.
+        :raises ValueError: If the order does not exist, or the new status breaks the rules.
+        """
+        query, update = Order.status_append(order_id, new_status)
+        if not await self.push_history(Order, StatusHistoryBucket, query, update, Order.STATUS_HISTORY_WINDOW):
+            history = Order._fields['statusHistory'].db_field
+            latest = await self.collection(Order).find_one({'_id': order_id}, {history: {'$slice': -1}})
+            raise ValueError(Order.push_status_error(latest, new_status))
+
+    async def change_price(self, product_id, new_price: PriceHistory):
+        """
+        Product.push_price for Motor, with the same rules and the same error messages.
+        :raises ValueError: If the product does not exist, or the new price breaks the rules.
+        """
+        query, update = Product.price_append(product_id, new_price)
+        if not await self.push_history(Product, PriceHistoryBucket, query, update, Product.PRICE_HISTORY_WINDOW):
+            history = Product._fields['priceHistory'].db_field
+            latest = await self.collection(Product).find_one({'_id': product_id}, {history: {'$slice': -1}})
+            raise ValueError(Product.push_price_error(latest, new_price))
+        invalidate(Product, product_id)
+
+    async def cascade_delete(self, parent, parent_attribute: str, other_attribute: str,
+                             release_stock: bool = False, bucket_class=None) -> DeleteReport:
+        """
+        CascadeUtilities.cascade_delete for Motor.  Outside of a transaction, deleting the items and
+        pulling them from the other side run at the same time; inside one, the statements of a
+        session have to go one after the other.
+        :param parent:              The Order or Product instance to delete.
+        :param parent_attribute:    The OrderItem attribute that references the parent.
+        :param other_attribute:     The OrderItem attribute that references the other side.
+        :param release_stock:       If True, the quantities of the deleted items go back into stock.
+        :param bucket_class:        The HistoryBucket class that the history of the parent is archived in, if any.
+        :return:                    A DeleteReport with the counts.
+        """
+        parent_class = type(parent)
+        item_class, other_class, parent_column, other_items_column = \
+            cascade_classes(parent_class, parent_attribute, other_attribute)
+        report = DeleteReport(parent_class._get_collection_name(), other_class._get_collection_name())
+        other_column = item_class._fields[other_attribute].db_field
+        quantity_column = item_class._fields['quantity'].db_field
+        items = self.collection(item_class)
+
+        async def work(session):
+            found = await items.find({parent_column: parent.pk}, {'_id': 1, other_column: 1, quantity_column: 1},
+                                     session=session).to_list(length=None)
+            item_ids = {item['_id'] for item in found}
+            report.other_ids = {item[other_column] for item in found}
+            item_ids.update(reference_ids(parent, 'orderItems'))
+            item_ids = list(item_ids)
+            # Motor starts an operation as soon as it is called, so only call the second one
+            # early when there is no session to share.
+            def delete():
+                return items.delete_many({'_id': {'$in': item_ids}}, session=session)
+
+            def pull():
+                return self.collection(other_class).update_many(
+                    {other_items_column: {'$in': item_ids}},
+                    {'$pull': {other_items_column: {'$in': item_ids}}}, session=session)
+            if session is None:
+                deleted, pulled = await asyncio.gather(delete(), pull())
+            else:
+                deleted = await delete()
+                pulled = await pull()
+            report.items_deleted = deleted.deleted_count
+            report.others_updated = pulled.modified_count
+            requests = other_class.stock_release_requests(item_quantities(found, other_column, quantity_column)) \
+                if release_stock else []
+            if len(requests) > 0:
+                await self.collection(other_class).bulk_write(requests, ordered=False, session=session)
+            if bucket_class is not None:
+                report.buckets_deleted = (await self.collection(bucket_class).delete_many(
+                    bucket_class.owner_filter(parent.pk), session=session)).deleted_count
+            report.parents_deleted = (await self.collection(parent_class).delete_one(
+                {'_id': parent.pk}, session=session)).deleted_count
+
+        if await self.supports_transactions():
+            async with await self.client.start_session() as session:
+                await session.with_transaction(work)
+            report.in_transaction = True
+        else:
+            await work(None)
+        invalidate(parent_class, parent.pk)
+        if cached_columns_changed(other_class, [other_items_column]):
+            invalidate(other_class, *report.other_ids)
+        return report
+
+    async def cascade_delete_order(self, order: Order) -> DeleteReport:
+        return await self.cascade_delete(order, 'order', 'product', release_stock=True,
+                                         bucket_class=StatusHistoryBucket)
+
+    async def cascade_delete_product(self, product: Product) -> DeleteReport:
+        return await self.cascade_delete(product, 'product', 'order', bucket_class=PriceHistoryBucket)
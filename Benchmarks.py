@@ -0,0 +1,356 @@
+"""
+Created on 10/17/2026
+Benchmarks for the code paths that every menu choice goes through.  This builds a synthetic
+data set (products with a price history, orders with line items and a status history), times
+each code path over it, and writes the results as JSON so that one run can be compared to the
+next and a regression shows up as a number rather than a feeling.
+
+    python Benchmarks.py --output results.json
+    python Benchmarks.py --mock --products 500 --orders 200 --items 10
+    python Benchmarks.py --compare last_release.json --output results.json
+
+The database named by --database is dropped at the start AND at the end of the run, so never
+point it at data that you want to keep.  With --mock, mongomock stands in for the server (it
+has to be installed).  mongomock does not send command events, so round trips are only
+counted against a real mongod, and the features that it does not have (like $$NOW in the
+atomic status and price appends) show up as an error for that benchmark instead of a timing.
+"""
+import argparse
+import builtins
+import csv
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from importlib import metadata
+from unittest import mock
+
+import mongoengine
+
+from CommandLogger import register_listeners, traced_operation
+from ConstraintUtilities import ensure_indexes, load_index_cache, get_unique_indexes, unique_general, \
+    select_general
+from BulkUtilities import ingest_orders, import_products
+from CascadeUtilities import cascade_delete_order, cascade_delete_product
+from Order import Order
+from OrderItem import OrderItem
+from PriceHistory import PriceHistory
+from PriceHistoryBucket import PriceHistoryBucket
+from Product import Product
+from Status import Status
+from StatusChange import StatusChange
+from StatusHistoryBucket import StatusHistoryBucket
+
+# Bump this whenever the layout of the results changes, so that compare() can tell.
+RESULTS_VERSION: int = 1
+
+# The number of rows in each file that the import_products benchmark loads.
+IMPORT_ROWS: int = 100
+
+MODEL_CLASSES = (Order, Product, OrderItem, PriceHistoryBucket, StatusHistoryBucket)
+
+
+class Dataset:
+    """The synthetic documents that the benchmarks work on, as saved (pk is set) instances."""
+    def __init__(self):
+        self.products: [Product] = []
+        self.orders: [Order] = []
+        self.spare_products: [Product] = []     # Products with no order items, for add_item.
+        self.setup_seconds: float = 0.0
+
+
+def build_dataset(products: int, price_changes: int, orders: int, items: int, statuses: int) -> Dataset:
+    """
+    Generate the synthetic data and store it with the bulk loaders, so that setting up a large
+    data set does not take longer than the benchmarks themselves.  All of the history dates are
+    in the past, a minute apart, so that the benchmarks can append newer entries.
+    :param products:        The number of products.
+    :param price_changes:   The number of price history entries per product.
+    :param orders:          The number of orders.
+    :param items:           The number of line items per order, each for a different product.
+    :param statuses:        The number of status history entries per order.
+    :return:                The Dataset.
+    """
+    dataset = Dataset()
+    started = time.perf_counter()
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(days=30)
+    states = list(Status)
+    # The add_item benchmark needs products that are not on its order yet, as many as it adds.
+    for number in range(products * 2):
+        product = Product(f'B{number:06d}', f'Benchmark product {number}', 'Synthetic benchmark product',
+                          1000000, '10.00', '20.00')
+        for change in range(max(price_changes, 1)):
+            product.change_price(PriceHistory(f'{10 + change}.00', start + timedelta(minutes=change)))
+        (dataset.products if number < products else dataset.spare_products).append(product)
+    all_products = dataset.products + dataset.spare_products
+    inserted = Product._get_collection().insert_many([product.to_mongo() for product in all_products])
+    for product, product_id in zip(all_products, inserted.inserted_ids):
+        product.pk = product_id
+        product._created = False
+        product._clear_changed_fields()
+    lines = []
+    for number in range(orders):
+        order = Order(f'Benchmark customer {number}', start + timedelta(seconds=number), 'Benchmark clerk')
+        for change in range(max(statuses, 1)):
+            order.change_status(StatusChange(states[change % len(states)], start + timedelta(minutes=change)))
+        lines.append((order, [(dataset.products[(number * items + line) % products], 1)
+                              for line in range(min(items, products))]))
+        dataset.orders.append(order)
+    report = ingest_orders(lines)
+    if report.rejections:
+        raise RuntimeError(f'Could not build the data set: {report}')
+    dataset.setup_seconds = time.perf_counter() - started
+    return dataset
+
+
+def scripted_input(answers: list):
+    """
+    Stand in for input() with a fixed list of answers, and keep the prompts off the screen, so
+    that the interactive code paths can be timed.
+    :param answers: The answers to give, in order.
+    :return:        A context manager that patches input and print.
+    """
+    remaining = iter(answers)
+    return mock.patch.multiple(builtins, input=lambda prompt='': next(remaining), print=lambda *args, **kwargs: None)
+
+
+def run_case(name: str, operations: list, trace_commands: bool) -> dict:
+    """
+    Run one benchmark.  The first half of the operations is timed, one at a time, and the second
+    half runs under tracemalloc, which would otherwise slow down the timings a lot.
+    :param name:            The name of the benchmark.
+    :param operations:      A list of functions with no arguments, one per operation.
+    :param trace_commands:  True if the round trips to the server can be counted.
+    :return:                The results for this benchmark.
+    """
+    timed = operations[:max(1, len(operations) // 2)]
+    measured = operations[len(timed):]
+    durations = []
+    with traced_operation(f'benchmark.{name}') as trace:
+        started = time.perf_counter()
+        for operation in timed:
+            operation_started = time.perf_counter()
+            operation()
+            durations.append(time.perf_counter() - operation_started)
+        elapsed = time.perf_counter() - started
+    ranked = sorted(durations)
+    results = {'operations': len(timed),
+               'seconds': elapsed,
+               'ops_per_second': len(timed) / elapsed if elapsed else None,
+               'mean_micros': 1000000 * elapsed / len(timed),
+               'p50_micros': 1000000 * ranked[len(ranked) // 2],
+               'p95_micros': 1000000 * ranked[min(len(ranked) - 1, int(len(ranked) * 0.95))],
+               'round_trips_per_op': trace.round_trips / len(timed) if trace_commands else None,
+               'bytes_per_op': (trace.bytes_sent + trace.bytes_received) / len(timed) if trace_commands else None,
+               # In the order that they ran, which for order_add_item is the order that the list grew in.
+               'durations_micros': [1000000 * duration for duration in durations]}
+    if measured:
+        tracemalloc.start()
+        try:
+            for operation in measured:
+                operation()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        results['peak_memory_bytes'] = peak
+        results['retained_bytes_per_op'] = current / len(measured)
+    return results
+
+
+def benchmark_cases(dataset: Dataset, count: int) -> list:
+    """
+    Build the benchmarks, as (name, operations) pairs, in the order that they have to run in.  The
+    ones that delete come last, since they use up the data set.
+    :param dataset: The data set to run against.
+    :param count:   The number of operations per benchmark, at most.
+    :return:        The list of (name, [operation, ...]) pairs.
+    """
+    products = dataset.products[:count]
+    orders = dataset.orders[:count]
+    cases = []
+
+    # unique_general on a copy of an existing product, which has to find the conflict.
+    def unique_check(product):
+        duplicate = Product(product.productCode, product.productName, product.productDescription,
+                            product.quantityInStock, '10.00', '20.00')
+        return lambda: unique_general(duplicate)
+    cases.append(('unique_general', [unique_check(product) for product in products]))
+
+    # select_general for a product by products_pk, answering the prompts from a script.
+    constraints = get_unique_indexes(Product)
+    choice = [index['name'] for index in constraints].index('products_pk') + 1
+    attributes = constraints[choice - 1]['attributes']
+
+    def select(product):
+        answers = [str(choice)] + [getattr(product, attribute) for attribute in attributes]
+
+        def operation():
+            with scripted_input(answers):
+                return select_general(Product)
+        return operation
+    cases.append(('select_general', [select(product) for product in products]))
+
+    # Rendering, from freshly loaded documents, so that nothing is already dereferenced.
+    def render(cls, document):
+        return lambda: str(cls.objects(pk=document.pk).first())
+    cases.append(('order_str', [render(Order, order) for order in orders]))
+    cases.append(('product_str', [render(Product, product) for product in products]))
+
+    # The atomic appends, each a little later than the one before, and all of them in the past.
+    now = datetime.utcnow().replace(microsecond=0)
+    states = list(Status)
+
+    def status_change(order):
+        latest = order.statusHistory[-1].status
+        new_status = StatusChange(next(state for state in states if state != latest), now - timedelta(seconds=1))
+        return lambda: Order.push_status(order.pk, new_status)
+    cases.append(('push_status', [status_change(order) for order in orders]))
+
+    def price_change(product):
+        new_price = PriceHistory('99.99', now - timedelta(seconds=1))
+        return lambda: Product.push_price(product.pk, new_price)
+    cases.append(('push_price', [price_change(product) for product in products]))
+
+    # import_products, one file per operation.
+    def import_file(number):
+        descriptor, file_name = tempfile.mkstemp(prefix='benchmark_import_', suffix='.csv')
+        with os.fdopen(descriptor, 'w', newline='') as target:
+            writer = csv.DictWriter(target, ['product_code', 'product_name', 'product_description',
+                                             'quantity_in_stock', 'buy_price', 'msrp'])
+            writer.writeheader()
+            for row in range(IMPORT_ROWS):
+                writer.writerow({'product_code': f'I{number:04d}{row:04d}', 'product_name': f'Imported product {row}',
+                                 'product_description': 'Synthetic imported product', 'quantity_in_stock': 100,
+                                 'buy_price': '10.00', 'msrp': '20.00'})
+
+        def operation():
+            import_products(file_name)
+            os.remove(file_name)
+        return operation
+    cases.append(('import_products', [import_file(number) for number in range(max(2, count // 10))]))
+
+    # Growing one order's item list one product at a time, to see whether add_item slows down as
+    # the list gets longer.  The OrderItems are stored ahead of time, only add_item is timed.
+    growing = Order('Benchmark growing order', now, 'Benchmark clerk')
+    growing.save()
+    new_items = [OrderItem(growing, product, 1) for product in dataset.spare_products[:count * 2]]
+    if new_items:
+        OrderItem.objects.insert(new_items, load_bulk=False)
+    cases.append(('order_add_item', [lambda item=item: growing.add_item(item, atomic=True) for item in new_items]))
+
+    cases.append(('delete_order', [lambda order=order: cascade_delete_order(order) for order in orders]))
+    cases.append(('delete_product', [lambda product=product: cascade_delete_product(product)
+                                     for product in products]))
+    return cases
+
+
+def compare(previous: dict, current: dict, tolerance: float) -> [str]:
+    """
+    Compare two benchmark runs.
+    :param previous:    The results of the earlier run, as loaded from its JSON.
+    :param current:     The results of this run.
+    :param tolerance:   How much worse a number can get, as a fraction, before it counts.
+    :return:            A description of each regression, empty if there are none.
+    """
+    if previous.get('version') != current['version']:
+        return [f'Cannot compare results version {previous.get("version")} to {current["version"]}']
+    regressions = []
+    for name, now in current['cases'].items():
+        before = previous['cases'].get(name)
+        if before is None or 'error' in before or 'error' in now:
+            continue
+        # A benchmark that took no measurable time has no rate, and there is nothing to compare it to.
+        if before.get('ops_per_second') and now.get('ops_per_second') is not None \
+                and now['ops_per_second'] < before['ops_per_second'] * (1 - tolerance):
+            regressions.append(f'{name}: {now["ops_per_second"]:.1f} ops/sec, was {before["ops_per_second"]:.1f}')
+        if before.get('round_trips_per_op') is not None and now.get('round_trips_per_op') is not None \
+                and now['round_trips_per_op'] > before['round_trips_per_op']:
+            regressions.append(f'{name}: {now["round_trips_per_op"]:.2f} round trips per operation, '
+                               f'was {before["round_trips_per_op"]:.2f}')
+    return regressions
+
+
+def version_of(package: str):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def main(arguments: [str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the CRUD code paths.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017', help='The mongod to run against.')
+    parser.add_argument('--database', default='one_to_many_benchmark', help='Dropped before and after!')
+    parser.add_argument('--mock', action='store_true', help='Use mongomock instead of a server.')
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--price-changes', type=int, default=5)
+    parser.add_argument('--orders', type=int, default=100)
+    parser.add_argument('--items', type=int, default=10, help='Line items per order.')
+    parser.add_argument('--statuses', type=int, default=5, help='Status changes per order.')
+    parser.add_argument('--operations', type=int, default=100, help='Operations per benchmark, at most.')
+    parser.add_argument('--output', help='The JSON file to write the results to.')
+    parser.add_argument('--compare', help='The JSON results of an earlier run to check for regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='The fraction that ops/sec can drop by before it counts as a regression.')
+    options = parser.parse_args(arguments)
+
+    # The listener has to be in place before the client is created, or it never sees a command.
+    register_listeners()
+    if options.mock:
+        import mongomock
+        client = mongoengine.connect(options.database, host='mongodb://localhost',
+                                     mongo_client_class=mongomock.MongoClient)
+        server_version = None
+    else:
+        client = mongoengine.connect(options.database, host=options.uri)
+        server_version = client.server_info().get('version')
+    client.drop_database(options.database)
+    try:
+        for cls in MODEL_CLASSES:
+            ensure_indexes(cls)
+        load_index_cache(*MODEL_CLASSES)
+        dataset = build_dataset(options.products, options.price_changes, options.orders, options.items,
+                                options.statuses)
+        results = {'version': RESULTS_VERSION,
+                   'started': datetime.utcnow().isoformat(),
+                   'backend': 'mongomock' if options.mock else 'mongod',
+                   'server_version': server_version,
+                   'python': platform.python_version(),
+                   'pymongo': version_of('pymongo'),
+                   'mongoengine': version_of('mongoengine'),
+                   'parameters': {'products': options.products, 'price_changes': options.price_changes,
+                                  'orders': options.orders, 'items': options.items,
+                                  'statuses': options.statuses, 'operations': options.operations},
+                   'setup_seconds': dataset.setup_seconds,
+                   'cases': {}}
+        for name, operations in benchmark_cases(dataset, options.operations):
+            try:
+                results['cases'][name] = run_case(name, operations, not options.mock)
+            except Exception as e:
+                # One benchmark that cannot run (mongomock is missing something) should not stop the rest.
+                results['cases'][name] = {'error': f'{type(e).__name__}: {e}'}
+            case = results['cases'][name]
+            rate = f'{case["ops_per_second"]:10.1f}' if case.get('ops_per_second') is not None else f'{"-":>10}'
+            print(f'{name:16} ' + (f'error: {case["error"]}' if 'error' in case else
+                                   f'{rate} ops/sec  {case["mean_micros"]:10.0f} us/op  '
+                                   f'round trips/op: {case["round_trips_per_op"]}'))
+    finally:
+        client.drop_database(options.database)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if options.compare:
+        with open(options.compare) as previous:
+            regressions = compare(json.load(previous), results, options.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
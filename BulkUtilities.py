@@ -0,0 +1,350 @@
+"""
+Created on 10/17/2026
+Bulk loading utilities.  The interactive add_ methods in main.py and CommonUtilities.py create one
+document per prompt and one save() per document, which is fine for a clerk at a keyboard but not
+for loading a catalog of tens of thousands of products.  The routines in here work on whole
+chunks of documents at a time so that the number of round trips to the database stays small.
+"""
+import csv
+import json
+import time
+from datetime import datetime
+from decimal import InvalidOperation
+
+from mongoengine import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ConstraintUtilities import get_unique_indexes, column_value
+from DocumentCache import invalidate, cached_columns_changed
+from Order import Order
+from OrderItem import OrderItem
+from PriceHistory import PriceHistory
+from Product import Product
+from ReferenceUtilities import reference_id
+
+
+class ImportReport:
+    """
+    The results of one bulk import: how many rows were read and stored, which rows were
+    rejected and why, and how fast the whole thing went.
+    """
+    def __init__(self):
+        self.rows_read: int = 0
+        self.rows_inserted: int = 0
+        # A list of (row number, reason) tuples, one per row that did not make it into the database.
+        self.rejections: [tuple] = []
+        self.elapsed: float = 0.0
+
+    def reject(self, row_number: int, reason: str):
+        self.rejections.append((row_number, reason))
+
+    def rows_per_second(self) -> float:
+        if self.elapsed > 0:
+            return self.rows_read / self.elapsed
+        else:
+            return 0.0
+
+    def __str__(self):
+        results = f'Read {self.rows_read} rows, inserted {self.rows_inserted}, rejected {len(self.rejections)} ' \
+                  f'in {self.elapsed:.2f} seconds ({self.rows_per_second():.0f} rows/sec)'
+        for row_number, reason in self.rejections:
+            results = results + '\n\t' + f'Row {row_number}: {reason}'
+        return results
+
+
+class IngestReport:
+    """
+    The results of one bulk order ingestion: how many orders and order items were stored, and
+    which of them were rejected and why.
+    """
+    def __init__(self):
+        self.orders_inserted: int = 0
+        self.items_inserted: int = 0
+        # A list of (description, reason) tuples, one per order or order item that was not stored.
+        self.rejections: [tuple] = []
+        self.elapsed: float = 0.0
+
+    def reject(self, description: str, reason: str):
+        self.rejections.append((description, reason))
+
+    def __str__(self):
+        results = f'Inserted {self.orders_inserted} orders and {self.items_inserted} order items, ' \
+                  f'rejected {len(self.rejections)} in {self.elapsed:.2f} seconds'
+        for description, reason in self.rejections:
+            results = results + '\n\t' + f'{description}: {reason}'
+        return results
+
+
+def read_rows(file_name: str):
+    """
+    Stream the rows out of a CSV or JSONL file, one dictionary per row.  The file type is decided
+    by the extension: .jsonl (or .json) is one JSON object per line, anything else is read as CSV
+    with a header line.  The keys are expected to be the column names in the products collection.
+    The lines of a JSONL file are not parsed here, so that a malformed line can be rejected on its
+    own by whoever reads the rows, rather than stopping the generator; see parse_row.
+    :param file_name:   The path to the file to read.
+    :return:            A generator of (row number, row) tuples, where a row is a dictionary for CSV
+                        and the line of text for JSONL.
+    """
+    with open(file_name, newline='') as source:
+        if file_name.endswith('.jsonl') or file_name.endswith('.json'):
+            for row_number, line in enumerate(source, start=1):
+                if line.strip():
+                    yield row_number, line
+        else:
+            # Row 1 is the header, so the data rows start at 2 to match what the user sees in the file.
+            for row_number, row in enumerate(csv.DictReader(source), start=2):
+                yield row_number, row
+
+
+def parse_row(row) -> dict:
+    """
+    :param row:                 A row from read_rows.
+    :return:                    The row as a dictionary.
+    :raises JSONDecodeError:    If the row is a line of JSONL that is not valid JSON.
+    """
+    return json.loads(row) if isinstance(row, str) else row
+
+
+def product_from_row(row: dict, price_change_date: datetime) -> Product:
+    """
+    Build one Product, along with its first PriceHistory entry, from an input row.  Just like
+    add_product, the first "price change" is the buy price on the day that the product was loaded.
+    :param row:                 A dictionary keyed by the column names in the products collection.
+    :param price_change_date:   The date and time to put on the first price history entry.
+    :return:                    The new (validated, but unsaved) Product instance.
+    :raises InvalidOperation:   If a price is not a number.
+    """
+    buy_price = str(row['buy_price'])
+    product = Product(str(row['product_code']),
+                      str(row['product_name']),
+                      str(row['product_description']),
+                      int(row['quantity_in_stock']),
+                      buy_price,
+                      str(row['msrp']))
+    product.change_price(PriceHistory(buy_price, price_change_date))
+    product.validate()
+    return product
+
+
+def import_products(file_name: str, chunk_size: int = 1000) -> ImportReport:
+    """
+    Load products from a CSV or JSONL file.  The rows are read as a stream and processed a chunk at a
+    time.  For each chunk, the products_pk uniqueness constraint is checked both within the chunk and
+    against the collection (with one $in query), and then the surviving products are written with a
+    single unordered insert_many.
+    :param file_name:   The CSV or JSONL file to read the products from.
+    :param chunk_size:  The number of rows to validate and insert per round trip.
+    :return:            An ImportReport with the counts, the rejected rows and the throughput.
+    """
+    report = ImportReport()
+    started = time.perf_counter()
+    price_change_date = datetime.now()
+    chunk = []  # (row number, Product) tuples waiting to be inserted.
+    for row_number, row in read_rows(file_name):
+        report.rows_read += 1
+        try:
+            chunk.append((row_number, product_from_row(parse_row(row), price_change_date)))
+        except json.JSONDecodeError as e:
+            report.reject(row_number, f'Invalid row: not valid JSON ({e})')
+        except InvalidOperation:
+            # Decimal128 says no more than the name of the condition, so say which it was.
+            report.reject(row_number, 'Invalid row: a price is not a number')
+        except (KeyError, ValueError, TypeError, ValidationError) as e:
+            report.reject(row_number, f'Invalid row: {e}')
+        if len(chunk) >= chunk_size:
+            insert_product_chunk(chunk, report)
+            chunk = []
+    if len(chunk) > 0:
+        insert_product_chunk(chunk, report)
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def insert_product_chunk(chunk: [tuple], report: ImportReport):
+    """
+    Check one chunk of new products against products_pk and insert the ones that pass.
+    :param chunk:   A list of (row number, Product) tuples.
+    :param report:  The ImportReport to record the rejections and the insert count in.
+    :return:        None
+    """
+    collection = Product._get_collection()
+    constraint = [index for index in get_unique_indexes(Product) if index['name'] == 'products_pk'][0]
+    columns = constraint['columns']
+    # Pair each product with its raw document and its key, the values of the products_pk columns.
+    candidates = []
+    seen = set()
+    for row_number, product in chunk:
+        document = product.to_mongo()
+        key = tuple(column_value(document, column) for column in columns)
+        if key in seen:
+            report.reject(row_number, f'Duplicate of an earlier row on {constraint["name"]}: {key}')
+        else:
+            seen.add(key)
+            candidates.append((row_number, document, key))
+    if len(candidates) == 0:
+        return
+    # One query for the whole chunk.  The $in on each column finds a superset of the collisions, so
+    # the exact key tuples still have to be compared on this side.
+    existing_keys = set()
+    query = {column: {'$in': list({key[position] for row_number, document, key in candidates})}
+             for position, column in enumerate(columns)}
+    for existing in collection.find(query, {column: 1 for column in columns}):
+        existing_keys.add(tuple(column_value(existing, column) for column in columns))
+    documents = []
+    row_numbers = []
+    for row_number, document, key in candidates:
+        if key in existing_keys:
+            report.reject(row_number, f'Violates {constraint["name"]}: {key} is already in the collection')
+        else:
+            documents.append(document)
+            row_numbers.append(row_number)
+    if len(documents) == 0:
+        return
+    try:
+        result = collection.insert_many(documents, ordered=False)
+        report.rows_inserted += len(result.inserted_ids)
+    except BulkWriteError as bwe:
+        # Someone else could have inserted one of these keys since we looked.  The unordered insert
+        # keeps going past those, so we just report the rows that failed.
+        details = bwe.details
+        report.rows_inserted += details.get('nInserted', 0)
+        for error in details.get('writeErrors', []):
+            report.reject(row_numbers[error['index']], error.get('errmsg', 'Write error'))
+
+
+def ingest_orders(orders: [tuple]) -> IngestReport:
+    """
+    Store many orders, each with its line items, in a constant number of round trips:
+        1.  One unordered insert_many for the orders that have not been saved yet.
+        2.  One unordered insert_many for all the new OrderItem documents.
+        3.  One bulk_write of $addToSet updates to the orderItems list of every affected Order.
+        4.  One bulk_write of $addToSet updates to the orderItems list of every affected Product.
+    Before step 2, the stock for every item is taken with one bulk_write of conditional updates (see
+    Product.reserve_stock_many), and an item that there is not enough stock for is rejected.
+    The orders can be a mix of new Order instances and orders that are already in the database.
+    The products must already be in the database.  Just like Order.add_item, a second line item
+    for the same product on the same order is ignored.
+    :param orders:  A list of (Order, [(Product, quantity), ...]) tuples.
+    :return:        An IngestReport with the counts and the rejected orders and items.
+    """
+    report = IngestReport()
+    started = time.perf_counter()
+    # Step 1: insert whichever orders are new.
+    new_orders = []
+    failed_orders = set()  # id() of the new orders that did not make it into the database.
+    for order, lines in orders:
+        if order.pk is None:
+            try:
+                order.validate()
+                new_orders.append(order)
+            except ValidationError as e:
+                failed_orders.add(id(order))
+                report.reject(f'Order {order.customerName} {order.orderDate}', f'Invalid order: {e}')
+    if len(new_orders) > 0:
+        documents = [order.to_mongo() for order in new_orders]
+        failed_positions = set()
+        try:
+            Order._get_collection().insert_many(documents, ordered=False)
+        except BulkWriteError as bwe:
+            for error in bwe.details.get('writeErrors', []):
+                failed_positions.add(error['index'])
+                order = new_orders[error['index']]
+                report.reject(f'Order {order.customerName} {order.orderDate}', error.get('errmsg', 'Write error'))
+        for position, order in enumerate(new_orders):
+            if position in failed_positions:
+                failed_orders.add(id(order))
+            else:
+                # insert_many put the generated _id into the raw document, hand it back to the Order.
+                order.pk = documents[position]['_id']
+                order._created = False
+                order._clear_changed_fields()
+                report.orders_inserted += 1
+    # Step 2: build and insert the order items for the orders that we have in the database.
+    items = []
+    seen = set()  # (order id, product id) pairs, order_items_pk within this batch.
+    for order, lines in orders:
+        if id(order) in failed_orders:
+            continue
+        for product, quantity in lines:
+            if (order.pk, product.pk) in seen:
+                continue  # Already in the order, don't add it.
+            seen.add((order.pk, product.pk))
+            item = OrderItem(order, product, quantity)
+            try:
+                item.validate()
+                items.append(item)
+            except ValidationError as e:
+                report.reject(f'Item {product.productCode} on order {order.pk}', f'Invalid order item: {e}')
+    # Take the stock for all of the items.  An item that cannot have its stock is not stored.
+    stock_failures = Product.reserve_stock_many([(item.product.pk, item.quantity) for item in items])
+    for position, reason in stock_failures.items():
+        item = items[position]
+        report.reject(f'Item {item.product.productCode} on order {item.order.pk}', reason)
+    items = [item for position, item in enumerate(items) if position not in stock_failures]
+    if len(items) == 0:
+        report.elapsed = time.perf_counter() - started
+        return report
+    documents = [item.to_mongo() for item in items]
+    failed_positions = set()
+    try:
+        OrderItem._get_collection().insert_many(documents, ordered=False)
+    except BulkWriteError as bwe:
+        for error in bwe.details.get('writeErrors', []):
+            failed_positions.add(error['index'])
+            item = items[error['index']]
+            report.reject(f'Item {item.product.productCode} on order {item.order.pk}',
+                          error.get('errmsg', 'Write error'))
+    # The items that did not go in give their stock back.
+    Product.release_stock(stock_quantities([item for position, item in enumerate(items)
+                                            if position in failed_positions]))
+    stored_items = []
+    for position, item in enumerate(items):
+        if position not in failed_positions:
+            item.pk = documents[position]['_id']
+            item._created = False
+            item._clear_changed_fields()
+            stored_items.append(item)
+    report.items_inserted = len(stored_items)
+    # Steps 3 & 4: add the new items to the back-reference lists on both sides, one bulk_write per side.
+    push_item_references(Order, [(item.order, item) for item in stored_items])
+    push_item_references(Product, [(item.product, item) for item in stored_items])
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def stock_quantities(items: list) -> dict:
+    """
+    Total up the quantities of some order items by product.
+    :param items:   The OrderItem instances.
+    :return:        {product _id: the total quantity}, for Product.release_stock.
+    """
+    quantities = {}
+    for item in items:
+        product_id = reference_id(item._data.get('product'))
+        quantities[product_id] = quantities.get(product_id, 0) + item.quantity
+    return quantities
+
+
+def push_item_references(cls, pairs: [tuple]):
+    """
+    Add OrderItem references to the orderItems list of their parents with one bulk_write.  There is
+    one $addToSet per parent document, no matter how many of its items are in the list.  The parent
+    instances that we have in memory get the same items added to them.
+    :param cls:     The parent class, Order or Product.
+    :param pairs:   A list of (parent, OrderItem) tuples.
+    :return:        None
+    """
+    column = cls._fields['orderItems'].db_field
+    by_parent = {}  # parent id --> (parent instance, [OrderItem ids])
+    for parent, item in pairs:
+        by_parent.setdefault(parent.pk, (parent, []))[1].append(item.pk)
+        parent.add_item(item)
+    if len(by_parent) > 0:
+        cls._get_collection().bulk_write(
+            [UpdateOne({'_id': parent_id}, {'$addToSet': {column: {'$each': item_ids}}})
+             for parent_id, (parent, item_ids) in by_parent.items()],
+            ordered=False)
+        if cached_columns_changed(cls, [column]):
+            invalidate(cls, *by_parent.keys())
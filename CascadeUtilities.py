@@ -0,0 +1,170 @@
+"""
+Created on 10/17/2026
+Cascading deletes for the two parents of OrderItem.  Deleting an Order or a Product means
+deleting all of its OrderItems, and then taking those items out of the orderItems list on the
+other side of the relationship.  Calling delete() on each OrderItem makes MongoEngine check its
+delete rules in Python and go to the database once per item, so instead this does the whole
+cascade with a fixed number of set-based statements, in a transaction when the server has them.
+"""
+from DocumentCache import invalidate, cached_columns_changed
+from PriceHistoryBucket import PriceHistoryBucket
+from ReferenceUtilities import reference_ids
+from StatusHistoryBucket import StatusHistoryBucket
+
+
+class DeleteReport:
+    """The number of documents that one cascading delete removed or changed."""
+    def __init__(self, parent: str, other: str):
+        """
+        :param parent:  The name of the collection that we deleted from, orders or products.
+        :param other:   The name of the collection on the other side of the OrderItems.
+        """
+        self.parent = parent
+        self.other = other
+        self.parents_deleted: int = 0
+        self.items_deleted: int = 0
+        self.others_updated: int = 0
+        self.buckets_deleted: int = 0
+        self.in_transaction: bool = False
+        self.other_ids: set = set()    # The _ids of the documents on the other side of the deleted items.
+
+    def __str__(self):
+        return f'Deleted {self.parents_deleted} from {self.parent} and {self.items_deleted} order items, ' \
+               f'removed the items from {self.others_updated} {self.other}' + \
+               (f', deleted {self.buckets_deleted} history buckets' if self.buckets_deleted else '') + \
+               (' (in a transaction)' if self.in_transaction else '')
+
+
+def supports_transactions(client) -> bool:
+    """
+    Multi-document transactions need a replica set or a sharded cluster, a standalone mongod
+    does not have them.
+    :param client:  The pymongo MongoClient.
+    :return:        True if we can start a transaction on this deployment.
+    """
+    topology = getattr(client, 'topology_description', None)
+    return topology is not None and topology.topology_type_name in ('ReplicaSetWithPrimary', 'Sharded')
+
+
+def run_in_transaction(client, work, report: DeleteReport):
+    """
+    Run some database work in a transaction if the deployment supports them, or just run it.
+    :param client:  The pymongo MongoClient.
+    :param work:    A function that takes the session (or None) and does the writes.
+    :param report:  The report to note the use of a transaction in.
+    :return:        None
+    """
+    if supports_transactions(client):
+        with client.start_session() as session:
+            session.with_transaction(work)
+        report.in_transaction = True
+    else:
+        work(None)
+
+
+def cascade_classes(parent_class, parent_attribute: str, other_attribute: str) -> tuple:
+    """
+    Work out what a cascading delete of a parent class has to touch.
+    :param parent_class:        Order or Product.
+    :param parent_attribute:    The OrderItem attribute that references the parent.
+    :param other_attribute:     The OrderItem attribute that references the other side.
+    :return:                    The OrderItem class, the class on the other side, the column in
+                                OrderItem that references the parent, and the orderItems column of
+                                the other side.
+    """
+    item_class = parent_class._fields['orderItems'].field.document_type
+    other_class = item_class._fields[other_attribute].document_type
+    return (item_class, other_class, item_class._fields[parent_attribute].db_field,
+            other_class._fields['orderItems'].db_field)
+
+
+def item_quantities(items: [dict], column: str, quantity_column: str) -> dict:
+    """
+    Total up the quantities of some raw (pymongo) OrderItem documents by one of their references.
+    :param items:           The OrderItem documents.
+    :param column:          The reference column to total by, normally the product.
+    :param quantity_column: The quantity column.
+    :return:                {referenced _id: the total quantity}.
+    """
+    quantities = {}
+    for item in items:
+        quantities[item[column]] = quantities.get(item[column], 0) + item[quantity_column]
+    return quantities
+
+
+def cascade_delete(parent, parent_attribute: str, other_attribute: str, release_stock: bool = False,
+                   bucket_class=None) -> DeleteReport:
+    """
+    Delete a parent of OrderItem along with all its OrderItems, in four statements no matter
+    how many items there are:
+        1.  Find the _ids of every OrderItem that references the parent.
+        2.  delete_many those OrderItems.
+        3.  update_many the documents on the other side to $pull those items from orderItems.
+        4.  Delete the parent itself.
+    :param parent:              The Order or Product instance to delete.
+    :param parent_attribute:    The OrderItem attribute that references the parent.
+    :param other_attribute:     The OrderItem attribute that references the other side.
+    :param release_stock:       If True, the other side is Product, and the quantities of the deleted
+                                items go back into stock, with one more bulk_write.
+    :param bucket_class:        The HistoryBucket class that the history of the parent is archived
+                                in, if any.  Its buckets for the parent go with one more delete_many.
+    :return:                    A DeleteReport with the counts.
+    """
+    parent_class = type(parent)
+    item_class, other_class, parent_column, other_items_column = \
+        cascade_classes(parent_class, parent_attribute, other_attribute)
+    other_column = item_class._fields[other_attribute].db_field
+    quantity_column = item_class._fields['quantity'].db_field
+    report = DeleteReport(parent_class._get_collection_name(), other_class._get_collection_name())
+    client = parent_class._get_db().client
+
+    def work(session):
+        # Go by the references on the OrderItems as well as the parent's own list, in case the two disagree.
+        items = list(item_class._get_collection().find({parent_column: parent.pk},
+                                                       {'_id': 1, other_column: 1, quantity_column: 1},
+                                                       session=session))
+        item_ids = {item['_id'] for item in items}
+        report.other_ids = {item[other_column] for item in items}
+        item_ids.update(reference_ids(parent, 'orderItems'))
+        item_ids = list(item_ids)
+        report.items_deleted = item_class._get_collection().delete_many(
+            {'_id': {'$in': item_ids}}, session=session).deleted_count
+        report.others_updated = other_class._get_collection().update_many(
+            {other_items_column: {'$in': item_ids}},
+            {'$pull': {other_items_column: {'$in': item_ids}}}, session=session).modified_count
+        if release_stock:
+            other_class.release_stock(item_quantities(items, other_column, quantity_column), session)
+        if bucket_class is not None:
+            report.buckets_deleted = bucket_class._get_collection().delete_many(
+                bucket_class.owner_filter(parent.pk), session=session).deleted_count
+        # The OrderItems are gone, so there is nothing left for the DENY delete rule to protect.
+        report.parents_deleted = parent_class._get_collection().delete_one(
+            {'_id': parent.pk}, session=session).deleted_count
+
+    run_in_transaction(client, work, report)
+    # The parent is gone.  The documents on the other side have only lost items (and maybe got stock
+    # back), which a cache may not even have.
+    invalidate(parent_class, parent.pk)
+    if cached_columns_changed(other_class, [other_items_column]):
+        invalidate(other_class, *report.other_ids)
+    return report
+
+
+def cascade_delete_order(order) -> DeleteReport:
+    """
+    Delete an order, all of its OrderItems, and the references to those items from the products.
+    The stock that the items took goes back to the products, and the archived status history goes.
+    :param order:   The Order to delete.
+    :return:        A DeleteReport with the counts.
+    """
+    return cascade_delete(order, 'order', 'product', release_stock=True, bucket_class=StatusHistoryBucket)
+
+
+def cascade_delete_product(product) -> DeleteReport:
+    """
+    Delete a product, all of the OrderItems for it, the references to those items from the orders,
+    and the archived price history of the product.
+    :param product: The Product to delete.
+    :return:        A DeleteReport with the counts.
+    """
+    return cascade_delete(product, 'product', 'order', bucket_class=PriceHistoryBucket)
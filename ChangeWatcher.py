@@ -0,0 +1,233 @@
+"""
+Created on 10/17/2026
+A background thread that follows the change streams of the products, orders and order_items
+collections, so that the changes that other processes make reach this one.  For each change it:
+    -   invalidates the cached copy of the changed document if a cached field changed (see
+        DocumentCache), and
+    -   keeps two materialized views up to date, one change at a time:
+            product_prices          {_id: product _id, price, date}: the current price of each product.
+            order_status_counts     {_id: status, count}: how many orders are currently in each status.
+        order_statuses ({_id: order _id, status}) remembers the status that each order was counted
+        under, so that a change can move it from one count to another, and so that applying the
+        same change twice does not count it twice.
+The resume token of the last change applied is stored in change_stream_tokens, and a restarted
+watcher picks up from there.  Change streams need a replica set; a single node replica set
+(mongod --replSet rs0, then rs.initiate()) is enough to run this locally.
+"""
+import logging
+import threading
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from DocumentCache import invalidate, cached_columns_changed
+from Order import Order
+from OrderItem import OrderItem
+from PriceHistory import PriceHistory
+from Product import Product, as_decimal
+from StatusChange import StatusChange
+
+log = logging.getLogger("MongoDB change watcher")
+
+# The server gives this code when the resume token is older than anything left in the oplog.
+CHANGE_STREAM_HISTORY_LOST: int = 286
+
+
+class ChangeWatcher(threading.Thread):
+    """Follows the change streams and applies each change to the caches and the views."""
+
+    # The classes whose collections we watch, by collection name.
+    WATCHED = {cls._get_collection_name(): cls for cls in (Product, Order, OrderItem)}
+
+    def __init__(self, db, name: str = 'default', max_await_ms: int = 1000, token_every: int = 100):
+        """
+        :param db:              The pymongo Database.
+        :param name:            The name that this watcher stores its resume token under.  Watchers
+                                that maintain the same views should share it.
+        :param max_await_ms:    How long to wait for a change before checking whether to stop.
+        :param token_every:     Store the resume token after this many changes, and whenever the
+                                stream goes quiet.
+        """
+        super().__init__(name=f'ChangeWatcher-{name}', daemon=True)
+        self.db = db
+        self.watcher_name = name
+        self.max_await_ms = max_await_ms
+        self.token_every = token_every
+        self.stopping = threading.Event()
+        self.applied: int = 0
+        self.prices = db['product_prices']
+        self.statuses = db['order_statuses']
+        self.counts = db['order_status_counts']
+        self.tokens = db['change_stream_tokens']
+        self.price_history = Product._fields['priceHistory'].db_field
+        self.status_history = Order._fields['statusHistory'].db_field
+
+    def pipeline(self) -> [dict]:
+        """
+        Only the changes to the watched collections, with the full documents cut down to what the
+        views need: no orderItems, and only the latest entry of each history.
+        """
+        trimmed = {}
+        for history in (self.price_history, self.status_history):
+            field = f'$fullDocument.{history}'
+            trimmed[f'fullDocument.{history}'] = {'$cond': [{'$isArray': field}, {'$slice': [field, -1]}, '$$REMOVE']}
+        return [{'$match': {'ns.coll': {'$in': list(ChangeWatcher.WATCHED.keys())}}},
+                {'$unset': ['fullDocument.' + Product._fields['orderItems'].db_field,
+                            'fullDocument.' + Order._fields['orderItems'].db_field]},
+                {'$set': trimmed}]
+
+    def run(self):
+        while not self.stopping.is_set():
+            token = self.load_token()
+            try:
+                with self.db.watch(self.pipeline(), full_document='updateLookup', resume_after=token,
+                                   max_await_time_ms=self.max_await_ms) as stream:
+                    if token is None:
+                        # Rebuild only once the stream is open, so that nothing made during the
+                        # rebuild is missed.  Changes made during it are applied again, which the
+                        # views do not mind.
+                        self.rebuild_views()
+                    self.follow(stream)
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    log.warning('The stored resume token is too old, rebuilding the views.')
+                    self.tokens.delete_one({'_id': self.watcher_name})
+                else:
+                    log.exception('The change stream failed, trying again.')
+                    self.stopping.wait(1)
+            except PyMongoError:
+                log.exception('The change stream failed, trying again.')
+                self.stopping.wait(1)
+
+    def follow(self, stream):
+        """
+        Apply the changes from an open stream until we are told to stop.
+        :param stream:  The ChangeStream.
+        :return:        None
+        """
+        unsaved = 0
+        while not self.stopping.is_set() and stream.alive:
+            change = stream.try_next()
+            if change is not None:
+                self.apply(change)
+                unsaved += 1
+            if unsaved > 0 and (change is None or unsaved >= self.token_every):
+                self.save_token(stream.resume_token)
+                unsaved = 0
+        if unsaved > 0:
+            self.save_token(stream.resume_token)
+
+    def stop(self, timeout: float = None):
+        self.stopping.set()
+        self.join(timeout)
+
+    def load_token(self):
+        stored = self.tokens.find_one({'_id': self.watcher_name})
+        return stored['token'] if stored else None
+
+    def save_token(self, token):
+        self.tokens.update_one({'_id': self.watcher_name}, {'$set': {'token': token}}, upsert=True)
+
+    def apply(self, change: dict):
+        """
+        Apply one change event to the caches and the views.
+        :param change:  The change event, as it comes from the stream.
+        :return:        None
+        """
+        cls = ChangeWatcher.WATCHED.get(change['ns']['coll'])
+        document_id = change.get('documentKey', {}).get('_id')
+        if cls is None or document_id is None:
+            return
+        # An update says which columns it changed.  Anything else (an insert, a replace or a delete)
+        # could have changed any of them.
+        changed = change.get('updateDescription')
+        if changed is None or cached_columns_changed(
+                cls, list(changed.get('updatedFields', {}).keys()) + changed.get('removedFields', []) +
+                [truncated['field'] for truncated in changed.get('truncatedArrays', [])]):
+            invalidate(cls, document_id)
+        deleted = change['operationType'] == 'delete'
+        document = change.get('fullDocument')
+        if document is None and not deleted:
+            return  # The document was deleted again before the update could be looked up.
+        if cls is Product:
+            self.apply_price(document_id, None if deleted else document)
+        elif cls is Order:
+            self.apply_status(document_id, None if deleted else document)
+        self.applied += 1
+
+    def apply_price(self, product_id, product: dict):
+        """
+        :param product_id:  The _id of the changed product.
+        :param product:     The product as it is now, or None if it was deleted.
+        """
+        latest = (product or {}).get(self.price_history) or []
+        if len(latest) == 0:
+            self.prices.delete_one({'_id': product_id})
+        else:
+            self.prices.update_one({'_id': product_id},
+                                   {'$set': {'price': latest[-1][PriceHistory._fields['newPrice'].db_field],
+                                             'date': latest[-1][PriceHistory._fields['priceChangeDate'].db_field]}},
+                                   upsert=True)
+
+    def apply_status(self, order_id, order: dict):
+        """
+        Move an order from the count of the status that it was counted under to the count of its
+        current status.  The order_statuses document is swapped in one step, and only the one
+        change that actually swaps it touches the counts.
+        :param order_id:    The _id of the changed order.
+        :param order:       The order as it is now, or None if it was deleted.
+        """
+        latest = (order or {}).get(self.status_history) or []
+        status = (order or {}).get(Order._fields['currentStatus'].db_field) or \
+            (StatusChange._from_son(latest[-1]).status.value if latest else None)
+        if status is None:
+            before = self.statuses.find_one_and_delete({'_id': order_id})
+        else:
+            before = self.statuses.find_one_and_update({'_id': order_id}, {'$set': {'status': status}}, upsert=True)
+        previous = before['status'] if before else None
+        if previous != status:
+            if previous is not None:
+                self.counts.update_one({'_id': previous}, {'$inc': {'count': -1}})
+            if status is not None:
+                self.counts.update_one({'_id': status}, {'$inc': {'count': 1}}, upsert=True)
+
+    def rebuild_views(self):
+        """
+        Compute the views from scratch, for a watcher that has no resume token to go on.
+        :return:    None
+        """
+        price_column = PriceHistory._fields['newPrice'].db_field
+        date_column = PriceHistory._fields['priceChangeDate'].db_field
+        status_column = StatusChange._fields['status'].db_field
+        self.prices.delete_many({})
+        self.statuses.delete_many({})
+        self.counts.delete_many({})
+        prices = [{'_id': product['_id'], 'price': product[self.price_history][-1][price_column],
+                   'date': product[self.price_history][-1][date_column]}
+                  for product in Product._get_collection().find({}, {self.price_history: {'$slice': -1}})
+                  if product.get(self.price_history)]
+        if prices:
+            self.prices.insert_many(prices)
+        statuses = [{'_id': order['_id'], 'status': order[self.status_history][-1][status_column]}
+                    for order in Order._get_collection().find({}, {self.status_history: {'$slice': -1}})
+                    if order.get(self.status_history)]
+        if statuses:
+            self.statuses.insert_many(statuses)
+            counts = {}
+            for status in statuses:
+                counts[status['status']] = counts.get(status['status'], 0) + 1
+            self.counts.insert_many([{'_id': status, 'count': count} for status, count in counts.items()])
+        log.info('Rebuilt the views: %d product prices, %d order statuses.', len(prices), len(statuses))
+
+    def current_price(self, product_id):
+        """
+        :param product_id:  The _id of a product.
+        :return:            Its current price from the view, without reading the product, or None.
+        """
+        view = self.prices.find_one({'_id': product_id})
+        return as_decimal(view['price']) if view else None
+
+    def status_counts(self) -> dict:
+        """
+        :return:    {status value: the number of orders in that status}, from the view.
+        """
+        return {count['_id']: count['count'] for count in self.counts.find({'count': {'$gt': 0}})}
@@ -1,30 +1,353 @@
 # borrowed from: https://docs.mongoengine.org/guide/logging-monitoring.html
+import contextvars
+import functools
 import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import bson
 from pymongo import monitoring
-from menu_definitions import menu_logging
 
 
+# Importing this module has no side effects.  Nothing is logged until configure_logging sets a
+# level, and nothing is monitored until register_listeners is called, which has to happen before
+# the MongoClient is created.
 log = logging.getLogger("MongoDB logger")
-log_level: int = eval(menu_logging.menu_prompt())
-log.setLevel(log_level)
-logging.basicConfig(level=log_level)
+
+
+def level_from_name(name) -> int:
+    """
+    Convert a logging level given by name ('DEBUG', 'logging.DEBUG') or by number ('10') to its number.
+    :param name:    The level, as it comes from the menu, a config file, or the environment.
+    :return:        The numeric logging level.
+    """
+    name = str(name).strip()
+    if name.isdigit():
+        return int(name)
+    level = logging.getLevelName(name.split('.')[-1].upper())
+    if not isinstance(level, int):
+        raise ValueError(f'Not a logging level: {name}')
+    return level
+
+
+def configure_logging(level=None):
+    """
+    Set the logging level for the MongoDB logger, and for logging in general if it has not been
+    set up yet.
+    :param level:   The level, by name or number.  If None, the MONGO_LOG_LEVEL environment
+                    variable is used, and if that is not set either, nothing is changed.
+    :return:        None
+    """
+    level = level if level is not None else os.environ.get('MONGO_LOG_LEVEL')
+    if level is None:
+        return
+    log_level: int = level if isinstance(level, int) else level_from_name(level)
+    log.setLevel(log_level)
+    logging.basicConfig(level=log_level)
+
+
+# The listener that register_listeners put in, so that registering twice does not count everything twice.
+registered_listener = None
+
+
+def register_listeners(listener=None):
+    """
+    Register a CommandLogger with pymongo so that every command is counted, timed and traced.  pymongo
+    only hands global listeners to the clients created after they were registered, so call this
+    before connecting.  Calling it again does nothing.
+    :param listener:    The listener to register, by default a CommandLogger on the process metrics.
+    :return:            The registered listener.
+    """
+    global registered_listener
+    if registered_listener is None:
+        registered_listener = listener or CommandLogger()
+        monitoring.register(registered_listener)
+    return registered_listener
+
+
+class LatencyHistogram:
+    """
+    A histogram of command durations in microseconds.  The buckets double in width, so a fixed,
+    small number of counters covers everything from 1 microsecond to over a minute, and recording
+    a duration is just an increment.  The percentiles are therefore accurate to within a factor of
+    two, which is plenty to tell a 200 microsecond count from a 20 millisecond one.
+    """
+    BUCKETS: int = 27   # The last bucket holds everything from 2**26 microseconds (about 67 seconds) up.
+
+    def __init__(self):
+        self.counts = [0] * LatencyHistogram.BUCKETS
+        self.count: int = 0
+        self.total: int = 0
+        self.max: int = 0
+
+    def record(self, micros: int):
+        self.counts[min(max(int(micros), 1).bit_length() - 1, LatencyHistogram.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += micros
+        self.max = max(self.max, micros)
+
+    def percentile(self, fraction: float) -> int:
+        """
+        :param fraction:    The percentile wanted, as a fraction, for instance 0.95 for p95.
+        :return:            The upper bound, in microseconds, of the bucket holding that percentile.
+        """
+        if self.count == 0:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(2 ** (bucket + 1), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {'count': self.count,
+                'mean_micros': self.total / self.count if self.count else 0,
+                'p50_micros': self.percentile(0.50),
+                'p95_micros': self.percentile(0.95),
+                'p99_micros': self.percentile(0.99),
+                'max_micros': self.max}
+
+
+class OperationTrace:
+    """
+    What one application level operation (add_order, delete_product, ...) cost in terms of MongoDB
+    commands: how many round trips, how much time the server spent on them, and how many bytes of
+    BSON went each way.  Traces nest; the commands of an inner operation count for the outer one too.
+    """
+    def __init__(self, name: str, parent=None):
+        self.name = name
+        self.parent = parent
+        self.round_trips: int = 0
+        self.errors: int = 0
+        self.server_micros: int = 0
+        self.bytes_sent: int = 0
+        self.bytes_received: int = 0
+        self.commands: dict = {}  # command name --> the number of times it was sent
+        self.started = time.perf_counter()
+        self.elapsed: float = 0.0
+
+    def sent(self, event):
+        size = len(bson.encode(event.command))
+        trace = self
+        while trace is not None:
+            trace.bytes_sent += size
+            trace.commands[event.command_name] = trace.commands.get(event.command_name, 0) + 1
+            trace = trace.parent
+
+    def received(self, event, failed: bool):
+        size = len(bson.encode(event.failure if failed else event.reply))
+        trace = self
+        while trace is not None:
+            trace.round_trips += 1
+            trace.server_micros += event.duration_micros
+            trace.bytes_received += size
+            if failed:
+                trace.errors += 1
+            trace = trace.parent
+
+    def summary(self) -> dict:
+        return {'round_trips': self.round_trips, 'errors': self.errors, 'server_micros': self.server_micros,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                'elapsed_seconds': self.elapsed, 'commands': dict(self.commands)}
+
+    def __str__(self):
+        return f'Operation {self.name}: {self.round_trips} round trips ({self.errors} failed), ' \
+               f'{self.server_micros} microseconds on the server, {self.bytes_sent} bytes sent, ' \
+               f'{self.bytes_received} bytes received, {self.elapsed:.3f} seconds in all. ' \
+               f'Commands: {self.commands}'
+
+
+# The operation that the code running right now is part of, if any.  A ContextVar so that
+# each thread (and each asyncio task) has its own.
+current_operation = contextvars.ContextVar('current_operation', default=None)
+
+
+@contextmanager
+def traced_operation(name: str):
+    """
+    Tag every MongoDB command sent inside the with block as part of the named operation, and when
+    the block is done, log and record what the operation cost.
+    :param name:    The name of the operation, normally the name of the function doing it.
+    :return:        The OperationTrace, which is filled in as the commands complete.
+    """
+    trace = OperationTrace(name, current_operation.get())
+    token = current_operation.set(trace)
+    try:
+        yield trace
+    finally:
+        current_operation.reset(token)
+        trace.elapsed = time.perf_counter() - trace.started
+        metrics.operation_finished(trace)
+        if log.isEnabledFor(logging.INFO):
+            log.info('%s', trace)
+
+
+def traced(function):
+    """
+    Decorator that runs the whole function as one traced operation, named after the function.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with traced_operation(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class CommandMetrics:
+    """
+    Counts, error counts and latency histograms for the commands sent to MongoDB, totalled both by
+    command name (find, insert, update, ...) and by collection.  Everything is kept in memory and
+    can be read at any time with snapshot().
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands: dict = {}        # command name --> {'errors': int, 'latency': LatencyHistogram}
+        self.collections: dict = {}     # collection name --> the same
+        # operation name --> {'count', 'round_trips', 'server_micros', 'bytes_sent', 'bytes_received'}
+        self.operations: dict = {}
+        # The succeeded and failed events do not carry the command itself, so remember what each
+        # request was for when it starts.  Keyed by (connection, request id).
+        self.pending: dict = {}
+        # The timer for the next dump, and whether to keep dumping.  Both only change under the lock.
+        self.dump_timer = None
+        self.dumping: bool = False
+
+    @staticmethod
+    def collection_of(event) -> str:
+        """
+        :param event:   A CommandStartedEvent.
+        :return:        The name of the collection that the command is for, or None for commands
+                        like ping or endSessions that are not about any collection.
+        """
+        target = event.command.get(event.command_name)
+        if isinstance(target, str):
+            return target
+        # getMore has the cursor id in the command name key, and the collection under 'collection'.
+        return event.command.get('collection')
+
+    def started(self, event, trace: OperationTrace = None):
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = \
+                (event.command_name, self.collection_of(event), trace)
+
+    def finished(self, event, failed: bool) -> OperationTrace:
+        """
+        Record a command that has succeeded or failed.
+        :param event:   The CommandSucceededEvent or CommandFailedEvent.
+        :param failed:  True for a CommandFailedEvent.
+        :return:        The OperationTrace that was current when the command started, if any.
+        """
+        with self.lock:
+            command_name, collection, trace = self.pending.pop((event.connection_id, event.request_id),
+                                                               (event.command_name, None, None))
+            totals = [self.commands.setdefault(command_name, {'errors': 0, 'latency': LatencyHistogram()})]
+            if collection is not None:
+                totals.append(self.collections.setdefault(collection, {'errors': 0, 'latency': LatencyHistogram()}))
+            for total in totals:
+                total['latency'].record(event.duration_micros)
+                if failed:
+                    total['errors'] += 1
+        return trace
+
+    def operation_finished(self, trace: OperationTrace):
+        with self.lock:
+            total = self.operations.setdefault(trace.name, {'count': 0, 'round_trips': 0, 'server_micros': 0,
+                                                            'bytes_sent': 0, 'bytes_received': 0})
+            total['count'] += 1
+            total['round_trips'] += trace.round_trips
+            total['server_micros'] += trace.server_micros
+            total['bytes_sent'] += trace.bytes_sent
+            total['bytes_received'] += trace.bytes_received
+
+    def snapshot(self) -> dict:
+        """
+        :return:    {'commands': {name: summary}, 'collections': {name: summary}} where each summary
+                    has the count, errors, mean, p50, p95, p99 and max latency in microseconds, and
+                    {'operations': {name: totals}} with the totals of each traced operation.
+        """
+        with self.lock:
+            results = {group_name: {name: dict(total['latency'].summary(), errors=total['errors'])
+                                    for name, total in group.items()}
+                       for group_name, group in (('commands', self.commands), ('collections', self.collections))}
+            results['operations'] = {name: dict(total) for name, total in self.operations.items()}
+            return results
+
+    def reset(self):
+        with self.lock:
+            self.commands.clear()
+            self.collections.clear()
+            self.operations.clear()
+
+    def start_dumping(self, interval: float, level: int = logging.INFO):
+        """
+        Log a snapshot of the metrics every interval seconds, from a background (daemon) timer.
+        :param interval:    The number of seconds between dumps.
+        :param level:       The logging level to log the snapshot at.
+        :return:            None
+        """
+        with self.lock:
+            if self.dump_timer is not None:
+                self.dump_timer.cancel()
+            self.dumping = True
+            self.arm_dump(interval, level)
+
+    def arm_dump(self, interval: float, level: int):
+        # Only call this while holding the lock.
+        def dump():
+            if log.isEnabledFor(level):
+                log.log(level, 'MongoDB command metrics: %s', self.snapshot())
+            with self.lock:
+                # Unless dumping was stopped, or restarted with a timer of its own, while we logged.
+                if self.dumping and self.dump_timer is timer:
+                    self.arm_dump(interval, level)
+        timer = threading.Timer(interval, dump)
+        timer.daemon = True
+        self.dump_timer = timer
+        timer.start()
+
+    def stop_dumping(self):
+        with self.lock:
+            self.dumping = False
+            if self.dump_timer is not None:
+                self.dump_timer.cancel()
+                self.dump_timer = None
+
+
+# The metrics for the whole process.  Every CommandLogger adds to these unless it is given its own.
+metrics = CommandMetrics()
 
 
 class CommandLogger(monitoring.CommandListener):
 
+    def __init__(self, command_metrics: CommandMetrics = None):
+        self.metrics = command_metrics or metrics
+
+    # The messages are only formatted if debug logging is on, the metrics are always kept.
     def started(self, event):
-        log.debug("Command {0.command_name} with request id "
-                  "{0.request_id} started on server "
-                  "{0.connection_id}".format(event))
+        trace = current_operation.get()
+        if trace is not None:
+            trace.sent(event)  # Only encode the command to measure it when someone is tracing.
+        self.metrics.started(event, trace)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Command %s with request id %s started on server %s",
+                      event.command_name, event.request_id, event.connection_id)
 
     def succeeded(self, event):
-        log.debug("Command {0.command_name} with request id "
-                  "{0.request_id} on server {0.connection_id} "
-                  "succeeded in {0.duration_micros} "
-                  "microseconds".format(event))
+        trace = self.metrics.finished(event, failed=False)
+        if trace is not None:
+            trace.received(event, failed=False)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Command %s with request id %s on server %s succeeded in %s microseconds",
+                      event.command_name, event.request_id, event.connection_id, event.duration_micros)
 
     def failed(self, event):
-        log.debug("Command {0.command_name} with request id "
-                  "{0.request_id} on server {0.connection_id} "
-                  "failed in {0.duration_micros} "
-                  "microseconds".format(event))
+        trace = self.metrics.finished(event, failed=True)
+        if trace is not None:
+            trace.received(event, failed=True)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Command %s with request id %s on server %s failed in %s microseconds",
+                      event.command_name, event.request_id, event.connection_id, event.duration_micros)
@@ -4,8 +4,10 @@ These are utilities that are common between the sample code and the worked homew
 assignment.
 """
 from Utilities import Utilities
-from ConstraintUtilities import select_general, unique_general, prompt_for_date
+from CommandLogger import traced
+from ConstraintUtilities import select_general, insert_unique, prompt_for_date
 from Order import Order
+from CascadeUtilities import cascade_delete_order
 from StatusChange import StatusChange
 from Menu import Menu
 from Option import Option
@@ -39,6 +41,7 @@ def prompt_for_enum(prompt: str, cls, attribute_name: str):
         raise ValueError(f'This attribute is not an enum: {attribute_name}')
 
 
+@traced
 def add_order():
     """
     Create a new Order instance.
@@ -53,24 +56,26 @@ def add_order():
         new_order = Order(input('Customer name --> '),
                           order_date,
                           input('Clerk who made the sale --> '))
-        violated_constraints = unique_general(new_order)
+        # The first "stats change" is placing the order itself.
+        new_order.change_status(StatusChange(
+            prompt_for_enum('Select the status:', StatusChange, 'status'),
+            order_date))
+        try:
+            # Straight to the insert, and let orders_pk say whether this order is a duplicate.
+            violated_constraints = insert_unique(new_order)
+        except Exception as e:
+            print('Errors storing the new order:')
+            print(Utilities.print_exception(e))
+            continue
         if len(violated_constraints) > 0:
             for violated_constraint in violated_constraints:
                 print('Your input values violated constraint: ', violated_constraint)
             print('try again')
         else:
-            # The first "stats change" is placing the order itself.
-            new_order.change_status(StatusChange(
-                prompt_for_enum('Select the status:', StatusChange, 'status'),
-                order_date))
-            try:
-                new_order.save()
-                success = True
-            except Exception as e:
-                print('Errors storing the new order:')
-                print(Utilities.print_exception(e))
+            success = True
 
 
+@traced
 def update_order():
     """
     Change the status of an existing order by adding another element to the status vector of the order.
@@ -84,26 +89,24 @@ def update_order():
         status_change_date = prompt_for_date('Date and time of the status change: ')
         new_status = prompt_for_enum('Select the status:', StatusChange, 'status')
         try:
-            order.change_status(StatusChange(new_status, status_change_date))
-            order.save()
+            # Append the status change with an atomic $push rather than saving the entire order.
+            Order.push_status(order.pk, StatusChange(new_status, status_change_date))
             success = True
         except ValueError as VE:
             print('Attempted status change failed because:')
             print(VE)
 
 
+@traced
 def delete_order():
     """
     Delete an existing order from the database.
     :return: None
     """
     order = select_order()  # prompt the user for an order to delete
-    items = order.orderItems  # retrieve the list of items in this order
-    for item in items:
-        """The reference from OrderItem back up to Order has a reverse_delete_rule of DENY, which 
-        is similar to the RESTRICT option on a relational foreign key constraint.  Which means that
-        if I try to delete the order and there are still any OrderItems depending on that order,
-        MongoEngine (not MongoDB) will throw an exception."""
-        item.delete()
-    # Now that all the items on the order are removed, we can safely remove the order itself.
-    order.delete()
+    """The reference from OrderItem back up to Order has a reverse_delete_rule of DENY, which 
+    is similar to the RESTRICT option on a relational foreign key constraint.  Which means that
+    if I try to delete the order and there are still any OrderItems depending on that order,
+    MongoEngine (not MongoDB) will throw an exception.  So the items go first, all at once, and
+    they get pulled out of the products' lists of items at the same time."""
+    print(cascade_delete_order(order))
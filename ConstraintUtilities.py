@@ -1,9 +1,11 @@
 import datetime
 
 from mongoengine import EmbeddedDocumentField
+from pymongo.errors import DuplicateKeyError
 
 from Menu import Menu
 from Option import Option
+from ReferenceUtilities import reference_id, forget_change
 
 
 def prompt_for_date(prompt: str) -> datetime:
@@ -31,6 +33,56 @@ def prompt_for_date(prompt: str) -> datetime:
             print('Please try again.')
 
 
+# The mapping between the physical column names and the attribute names of each Document class,
+# keyed by the class.  The fields of a class never change while we are running, so the map is
+# worked out once per class and every lookup after that is a dictionary hit.
+_field_maps: dict = {}
+
+
+def embedded_type(field):
+    """
+    Return the EmbeddedDocument class inside a field, if there is one.
+    :param field:   A MongoEngine field.
+    :return:        The embedded class for an EmbeddedDocumentField, or for a list of them, else None.
+    """
+    if isinstance(field, EmbeddedDocumentField):
+        return field.document_type
+    inner = getattr(field, 'field', None)  # ListField and its relatives keep the element field here.
+    if isinstance(inner, EmbeddedDocumentField):
+        return inner.document_type
+    return None
+
+
+def field_map(cls) -> dict:
+    """
+    Return the two-way mapping between column names and attribute names for a class, including the
+    dotted paths into embedded documents, such as status_history.status_change_date to
+    statusHistory.statusChangeDate.
+    :param cls:     The Document (or EmbeddedDocument) class.
+    :return:        {'columns': {column: attribute}, 'attributes': {attribute: column},
+                     'fields': {attribute: the MongoEngine field}}
+    """
+    mapping = _field_maps.get(cls)
+    if mapping is None:
+        mapping = {'columns': {}, 'attributes': {}, 'fields': {}}
+        for attribute, field in cls._fields.items():
+            mapping['columns'][field.db_field] = attribute
+            mapping['attributes'][attribute] = field.db_field
+            mapping['fields'][attribute] = field
+            embedded = embedded_type(field)
+            if embedded is not None:
+                # Work out the embedded class on its own, then prefix its paths with this attribute.
+                nested = field_map(embedded)
+                for column, nested_attribute in nested['columns'].items():
+                    mapping['columns'][field.db_field + '.' + column] = attribute + '.' + nested_attribute
+                for nested_attribute, column in nested['attributes'].items():
+                    mapping['attributes'][attribute + '.' + nested_attribute] = field.db_field + '.' + column
+                for nested_attribute, nested_field in nested['fields'].items():
+                    mapping['fields'][attribute + '.' + nested_attribute] = nested_field
+        _field_maps[cls] = mapping
+    return mapping
+
+
 def get_attr_from_column(cls, column_name) -> str:
     """
     Returns the name of the attribute that corresponds to the given column name.  The attribute
@@ -40,54 +92,128 @@ def get_attr_from_column(cls, column_name) -> str:
     :param column_name:     The column that we are looking for the corresponding attribute.
     :return:                THe name of the attribute for the given column.
     :history:               05/05/2024 - Updated to deal with embedded column.
+                            10/17/2026 - Looked up in the per-class field_map instead of scanning _fields.
+    """
+    return field_map(cls)['columns'].get(column_name)
+
+
+def get_column_from_attr(cls, attribute_name) -> str:
+    """
+    Returns the name of the column that corresponds to the given attribute name, the reverse of
+    get_attr_from_column.
+    :param cls:             The class that has the attribute.
+    :param attribute_name:  The attribute, using the dot notation for embedded attributes.
+    :return:                The physical column name, or None if there is no such attribute.
+    """
+    return field_map(cls)['attributes'].get(attribute_name)
+
+
+# The unique indexes of each Document class, keyed by the class itself.  Each entry is a list of
+# dictionaries: {'name': index name, 'columns': [db column names], 'attributes': [attribute names]}.
+# The indexes on a collection only change when ensure_indexes runs, so there is no reason to go
+# back to the server for index_information() every time that we validate or select a document.
+_index_cache: dict = {}
+
+
+def get_unique_indexes(cls) -> list:
+    """
+    Return the uniqueness constraints on the collection behind cls, with the column names already
+    converted to attribute names.  The first call for a given class reads index_information() from
+    the database, every call after that is answered out of the cache.
+    :param cls:     The MongoEngine Document class whose unique indexes we want.
+    :return:        A list of {'name', 'columns', 'attributes'} dictionaries, one per unique index.
+    """
+    constraints = _index_cache.get(cls)
+    if constraints is None:
+        index_info = cls._get_collection().index_information()
+        constraints = []
+        for index in index_info.keys():
+            # see if the index is unique.  If not, we're not interested in using it.
+            # _id_ does not have a property named unique since _id_ is ALWAYS unique.
+            # Normally, _id_ is assigned by MongoDB, but the user COULD use that for a descriptive
+            # attribute, which COULD mean that there is a document with that _id_ value already.
+            if index == '_id_' or index_info[index].get('unique', False):
+                # harvest the list of column names from this index.
+                columns = [col[0] for col in index_info[index]['key']]
+                constraints.append({'name': index,
+                                    'columns': columns,
+                                    'attributes': [get_attr_from_column(cls, column) for column in columns]})
+        _index_cache[cls] = constraints
+    return constraints
+
+
+def load_index_cache(*classes):
     """
-    first_dot: int = column_name.find('.')  # see if we have an embedded field.
-    if first_dot > 0:  # we have a field that is embedded.
-        first = column_name[:first_dot]  # get just the first field for now
-        rest = column_name[first_dot + 1:]  # peel off the rest for next go around.
+    Fill the index cache for each of the supplied classes up front, typically at startup, so that
+    the first insert does not have to pay for the index_information() round trip.
+    :param classes: The MongoEngine Document classes to cache the unique indexes for.
+    :return:        None
+    """
+    for cls in classes:
+        get_unique_indexes(cls)
+
+
+def invalidate_index_cache(cls=None):
+    """
+    Throw away the cached unique indexes so that the next lookup reads them from the database again.
+    :param cls:     The class to forget about.  If None, the cache is emptied for every class.
+    :return:        None
+    """
+    if cls is None:
+        _index_cache.clear()
     else:
-        first = column_name  # this is all that we have to do, no nesting past this.
-    # loop through the cls OO attributes in the cls class, looking for the physical name provided.
-    for attribute in cls.__dict__['_fields'].keys():
-        # the 'id' attribute is a legitimate attribute with a db_name of _id, so we'll use it if need be.
-        # if attribute != 'id':  # Skip the obligatory id field
-        # Todo I'm not sure what happens with a dict or list attribute in the class.
-        if getattr(cls, attribute).__dict__['db_field'] == first:  # Found the right attribute.
-            if first_dot > 0:
-                """getattr(cls, first) returns the attribute that corresponds to the given field.
-                Then we get the document type from MongoEngine for that, which gives us the class it belongs to.
-                Then we find the attribute name corresponding to the next column in line."""
-                rest_attr = get_attr_from_column(getattr(cls, first).document_type, rest)
-                return attribute + '.' + rest_attr
-            else:
-                return attribute
+        _index_cache.pop(cls, None)
+
+
+def ensure_indexes(cls):
+    """
+    Build the indexes declared in the meta of cls, and drop whatever we had cached for that class
+    since the set of indexes on the collection may have just changed.
+    :param cls:     The MongoEngine Document class to ensure the indexes for.
+    :return:        None
+    """
+    cls.ensure_indexes()
+    invalidate_index_cache(cls)
+
+
+def cache_for(cls):
+    """
+    :param cls: A MongoEngine Document class.
+    :return:    The DocumentCache of that class, or None if it is not cached.
+    """
+    # DocumentCache uses this module, so it is imported here rather than at the top.
+    from DocumentCache import cache_for as registered_cache
+    return registered_cache(cls)
 
 
-def select_general(cls):
+def select_general(cls, resolved: dict = None):
     """Return one instance of the class that's supplied as an input, by prompting the user for
     the values of the selected uniqueness constraint for the collection corresponding to that class.
     :param cls: The class that the user wants a single instance of.
+    :param resolved:    The documents already found during this selection, shared with the
+                        recursive calls for the referenced parents, keyed by (class, _id).  The
+                        references of the selected document are pointed at these, so that using
+                        them does not go back to the database for the same parents.  Only the
+                        parents can come out of a DocumentCache; the instance that the user selects
+                        is always read from the database in full, so that the caller can change it.
     :return: The instance that the user selected.
     :history:   05/07/2024 - Updated to use extract_attr instead of getattr to handle nested attributes."""
-    # If we were doing this directly in mongodb, we'd say collection=db[whatever collection it is]
-    collection = cls._get_collection()
-    index_info = collection.index_information()
-    # Loop through the indexes of the collection.
+    selecting_parent = resolved is not None
+    if resolved is None:
+        resolved = {}
+    # The unique indexes come out of the per-class cache rather than a fresh index_information() call.
+    constraints = get_unique_indexes(cls)
     choices = []
-    for index in index_info.keys():
-        # see if the index is unique.  If not, we're not interested in using it.
-        # _id_ does not have a property named unique since _id_ is ALWAYS unique.  Hence, the order in the if statement.
-        if index == '_id_' or index_info[index]['unique']:
-            columns = [col[0] for col in index_info[index]['key']]
-            choices.append(Option(f'index: {index} - cols: {columns}', index))
+    for constraint in constraints:
+        choices.append(Option(f'index: {constraint["name"]} - cols: {constraint["columns"]}', constraint))
     index_menu = Menu('which index', 'Which index do you want to search by:', choices)
     while True:
         # What happens if there are no unique indexes at all?
         chosen_index = index_menu.menu_prompt()
-        filters = {}  # The attribute/value pairs that we're going to search by
-        for column in [col[0] for col in index_info[chosen_index]['key']]:
-            # now I have to convert from the column name to the attribute name.
-            attribute_name = get_attr_from_column(cls, column)
+        # Select the referenced parents in this index first, once.  If the lookup fails, only the
+        # other values are asked for again.
+        parents = {}  # field name --> the selected parent document
+        for attribute_name in chosen_index['attributes']:
             # If this attribute is a reference, we need to go find that referenced document.
             attribute = extract_attr(cls, attribute_name)
             if type(attribute).__name__ == 'ReferenceField':
@@ -95,35 +221,156 @@ def select_general(cls):
                 # Now we have to figure out the class that we're referencing.
                 referenced_class = attribute.document_type
                 # Use my general selection utility to find an instance of the referenced parent
-                target = select_general(referenced_class)
                 # and add the filter to point to the selected document in the parent collection.
                 # I could have just said: filters[attribute_name] = select_general(attribute.document_type)
                 # If the attribute is embedded, we need to make the '.' in the path to become a '__' for
                 # MongoEngine.  Hopefully, we never have an attribute name with an embedded '.'
-                field_name = attribute_name.replace('.', '__')
-                filters[field_name] = target
+                parents[attribute_name.replace('.', '__')] = select_general(referenced_class, resolved)
                 """This is intentionally recursive.  If A is a parent to B and B has a reference to A,
                 and that reference is part of the uniqueness constraint in B that we are using to select 
                 an instance of B, and B is a parent to C and C has a reference to B, and we want to select
                 an instance of C based on the "migrated" reference to B, then you see where the 
                 recursion comes in very handy."""
-            elif type(attribute).__name__ == 'DateTimeField':
-                field_name = attribute_name.replace('.', '__')
-                filters[field_name] = prompt_for_date(f'search for {attribute_name} = --> ')
-            elif type(attribute).__name__ == 'IntField':
+        while True:
+            filters = dict(parents)  # The attribute/value pairs that we're going to search by
+            for attribute_name in chosen_index['attributes']:
+                attribute = extract_attr(cls, attribute_name)
                 field_name = attribute_name.replace('.', '__')
-                filters[field_name] = int(input(f'search for integer {attribute_name} = --> '))
+                if type(attribute).__name__ == 'ReferenceField':
+                    continue  # Already selected.
+                elif type(attribute).__name__ == 'DateTimeField':
+                    filters[field_name] = prompt_for_date(f'search for {attribute_name} = --> ')
+                elif type(attribute).__name__ == 'IntField':
+                    filters[field_name] = int(input(f'search for integer {attribute_name} = --> '))
+                else:
+                    # It's not a reference, so prompt for the literal value.
+                    # This works for string and numeric, but honestly, I should convert the string depending on
+                    # the type.
+                    # MongoEngine will search on nested attributes, but the . has to --> __
+                    filters[field_name] = input(f'search for {attribute_name} = --> ')
+            cache = cache_for(cls)
+            if selecting_parent and cache is not None and cache.index_name == chosen_index['name']:
+                # A parent of a cached class looked up by the key of its cache.  The parent is only
+                # referenced, so the read only copy out of the cache will do.  The index is unique, so
+                # there is never more than one.
+                document = cache.fetch_by_key({attribute_name: filters[attribute_name.replace('.', '__')]
+                                               for attribute_name in chosen_index['attributes']})
+                found = [document] if document is not None else []
             else:
-                # It's not a reference, so prompt for the literal value.
-                # This works for string and numeric, but honestly, I should convert the string depending on the type.
-                # MongoEngine will search on nested attributes, but the . has to --> __
-                field_name = attribute_name.replace('.', '__')
-                filters[field_name] = input(f'search for {attribute_name} = --> ')
-        # count the number of rows that meet that criteria.
-        if cls.objects(**filters).count() == 1:
-            return cls.objects(**filters).first()
+                # Fetch at most two rows that meet that criteria.  One query both brings back the document
+                # and tells us whether the criteria were ambiguous, without a separate count.
+                found = list(cls.objects(**filters).limit(2))
+            if len(found) == 1:
+                document = found[0]
+                resolved[(cls, document.pk)] = document
+                # Hand the parents that were just selected to the document's references, rather than
+                # have MongoEngine dereference each of them again with a query of its own.  They are
+                # the same documents that the references already point to, so they are not changes.
+                for attribute_name, field in document._fields.items():
+                    if type(field).__name__ == 'ReferenceField':
+                        parent = resolved.get((field.document_type, reference_id(document._data.get(attribute_name))))
+                        if parent is not None:
+                            setattr(document, attribute_name, parent)
+                            forget_change(document, attribute_name)
+                return document
+            elif len(found) > 1:
+                print('Sorry, more than one row matches those criteria.  Try again.')
+            else:
+                print('Sorry, no rows found that match those criteria.  Try again.')
+            if len(parents) == len(chosen_index['attributes']):
+                # The index is nothing but the parents, so there is nothing else to ask for again.
+                # Start over from the index, and select the parents anew.
+                break
+
+
+def find_by_unique(cls, index_name: str, **values):
+    """
+    The non-interactive version of select_general: find the one document of cls that has the given
+    values for the columns of a uniqueness constraint.  See find_many_by_unique for the values.
+    :param cls:         The class that we want an instance of.
+    :param index_name:  The name of the unique index to look up by, for instance products_pk.
+    :param values:      The value of each attribute in that index, by attribute name.
+    :return:            The matching instance, or None if there is none.
+    """
+    return find_many_by_unique(cls, index_name, [values])[0]
+
+
+def find_many_by_unique(cls, index_name: str, keys: [dict], ids_only: bool = False) -> list:
+    """
+    Find many documents of cls by the values of one uniqueness constraint, with one query for all of
+    them.  Each key is a dictionary from attribute name (as in the 'attributes' of get_unique_indexes)
+    to value.  The value of a ReferenceField attribute can be the referenced document, its _id, or a
+    dictionary with the key of the referenced document on one of its own unique indexes.  Those
+    nested keys are resolved first, to just the _ids of the referenced documents, with one query per
+    referenced class and unique index for all of the keys.
+    :param cls:         The class that we want instances of.
+    :param index_name:  The name of the unique index to look up by.
+    :param keys:        A list of {attribute name: value} dictionaries.
+    :param ids_only:    If True, only read the _ids of the matching documents, not the documents.
+    :return:            A list with the matching instance (or its _id, or None) for each key, in the
+                        same order.
+    """
+    matches = [index for index in get_unique_indexes(cls) if index['name'] == index_name]
+    if len(matches) == 0:
+        raise ValueError(f'There is no unique index named {index_name} on {cls.__name__}')
+    constraint = matches[0]
+    attributes = constraint['attributes']
+    fields = [extract_attr(cls, attribute_name) for attribute_name in attributes]
+    for key in keys:
+        missing = [attribute_name for attribute_name in attributes if attribute_name not in key]
+        if len(missing) > 0:
+            raise ValueError(f'The key {key} is missing {missing} for {index_name}')
+    # Resolve the nested keys of each referenced parent class in bulk.  Each nested key can be on a
+    # different unique index of the parent, so they are looked up one index at a time.
+    values = [[key[attribute_name] for attribute_name in attributes] for key in keys]
+    for position, field in enumerate(fields):
+        if type(field).__name__ == 'ReferenceField':
+            by_index = {}  # parent index name --> the rows whose nested key is on that index
+            for row in values:
+                if isinstance(row[position], dict):
+                    parent_index = index_for_attributes(field.document_type, row[position].keys())
+                    by_index.setdefault(parent_index, []).append(row)
+            for parent_index, rows in by_index.items():
+                parent_ids = find_many_by_unique(field.document_type, parent_index,
+                                                 [row[position] for row in rows], ids_only=True)
+                for row, parent_id in zip(rows, parent_ids):
+                    row[position] = parent_id
+    # Convert the keys to the values stored in the database, so that we can match the results back.
+    raw_keys = []
+    for row in values:
+        if any(value is None for value in row):
+            raw_keys.append(None)  # A nested key that did not resolve, so this key cannot match anything.
+        else:
+            raw_keys.append(tuple(field.to_mongo(value) for field, value in zip(fields, row)))
+    wanted = list({raw_key for raw_key in raw_keys if raw_key is not None})
+    found = {}
+    if len(wanted) > 0:
+        columns = constraint['columns']
+        if len(columns) == 1:
+            query = {columns[0]: {'$in': [raw_key[0] for raw_key in wanted]}}
         else:
-            print('Sorry, no rows found that match those criteria.  Try again.')
+            query = {'$or': [dict(zip(columns, raw_key)) for raw_key in wanted]}
+        if ids_only:
+            for stored in cls._get_collection().find(query, {column: 1 for column in columns}):
+                found[tuple(column_value(stored, column) for column in columns)] = stored['_id']
+        else:
+            for document in cls.objects(__raw__=query):
+                stored = document.to_mongo()
+                found[tuple(column_value(stored, column) for column in columns)] = document
+    return [found.get(raw_key) if raw_key is not None else None for raw_key in raw_keys]
+
+
+def index_for_attributes(cls, attribute_names) -> str:
+    """
+    Find the unique index on cls that is made up of exactly the given attributes.
+    :param cls:             The MongoEngine Document class.
+    :param attribute_names: The attribute names that a nested key supplies.
+    :return:                The name of the matching unique index.
+    """
+    for index in get_unique_indexes(cls):
+        if set(index['attributes']) == set(attribute_names):
+            return index['name']
+    raise ValueError(f'No unique index on {cls.__name__} is made up of {list(attribute_names)}')
 
 
 def extract_attr(instance, attribute_name):
@@ -139,6 +386,11 @@ def extract_attr(instance, attribute_name):
     :return:                Either the attribute itself (if instance is a class) or the value of the attribute
                             if instance is an object.
     """
+    if isinstance(instance, type) and hasattr(instance, '_fields'):
+        # For a class, the attribute is the field definition, which we have already worked out.
+        field = field_map(instance)['fields'].get(attribute_name)
+        if field is not None:
+            return field
     first_dot: int = attribute_name.find('.')  # see if we have an embedded field.
     if first_dot < 0:  # This is the terminal case.  We're done.
         if isinstance(instance, EmbeddedDocumentField):
@@ -156,47 +408,142 @@ def extract_attr(instance, attribute_name):
             return extract_attr(getattr(instance, first), rest)
 
 
+def column_value(document: dict, column_name: str):
+    """
+    Return the value stored under a column name in a raw (pymongo) document.  The column name can
+    use the dot notation to reach into embedded documents, the same way that MongoDB index keys do.
+    :param document:        A dictionary as it comes back from pymongo, or from to_mongo().
+    :param column_name:     The physical name of the column, possibly dotted.
+    :return:                The value of that column, or None if the document does not have it.
+    """
+    value = document
+    for part in column_name.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def constraint_filter(document: dict, constraint: dict) -> dict:
+    """
+    Build the raw MongoDB filter that finds the document(s) that collide with the given document
+    on one uniqueness constraint.
+    :param document:    The to_mongo() version of the instance that we are checking.
+    :param constraint:  One of the constraint dictionaries from get_unique_indexes.
+    :return:            A {column: value} dictionary suitable for find().
+    """
+    return {column: column_value(document, column) for column in constraint['columns']}
+
+
+def uniqueness_query(instance) -> (list, dict, dict):
+    """
+    Build the one $or query that finds every document colliding with instance on any of the
+    uniqueness constraints of its collection.
+    :param instance:    An instance of a MongoEngine class.
+    :return:            The list of (constraint, filters) pairs being checked, the query, and the
+                        projection down to the key columns.  The query is None if there is
+                        nothing to check.
+    """
+    cls = instance.__class__  # get the class from the instance.
+    document = instance.to_mongo()  # The instance with the physical column names & the stored values.
+    constraints = []
+    for constraint in get_unique_indexes(cls):
+        filters = constraint_filter(document, constraint)
+        # An instance that has not been saved yet has no _id, and there is no sense asking about that.
+        if any(value is not None for value in filters.values()):
+            constraints.append((constraint, filters))
+    if len(constraints) == 0:
+        return constraints, None, None
+    projection = {column: 1 for constraint, filters in constraints for column in filters.keys()}
+    return constraints, {'$or': [filters for constraint, filters in constraints]}, projection
+
+
+def violations(constraints: list, found: [dict]) -> list:
+    """
+    Work out which constraint(s) the documents returned by the uniqueness_query collided with.
+    :param constraints: The (constraint, filters) pairs from uniqueness_query.
+    :param found:       The documents that the query returned.
+    :return:            A list of {'name', 'columns'} for each violated constraint.
+    """
+    violated_constraints = []
+    for constraint, filters in constraints:
+        for existing in found:
+            if all(column_value(existing, column) == value for column, value in filters.items()):
+                # there is a document in the collection that matches the supplied instance on all attributes
+                # of this uniqueness constraint.  So we have another uniqueness constraint violation.
+                violated_constraints.append({'name': constraint['name'], 'columns': constraint['columns']})
+                break
+    return violated_constraints
+
+
 def unique_general(instance):
     """
     Check all uniqueness constraints on the collection that instance belongs to and return those
     uniqueness constraints that have been violated.  If that returned list has no members, then
     the instance does not duplicate any documents already in the collection, and it is safe to
     save that instance.
+    All the constraints are checked with one $or query, projected down to just the key columns,
+    and then we work out which constraint(s) each of the returned documents collided with.
     :param instance:    An instance of a MongoEngine class that the user want to test against all
                         uniqueness constraints on that collection.
     :return:            A list of the 0 or more uniqueness constraints that have been violated.
     """
-    # If we were doing this directly in mongodb, we'd say collection=db[whatever collection it is]
-    cls = instance.__class__  # get the class from the instance.
-    collection = cls._get_collection()  # Get the collection corresponding to that class.
-    index_info = collection.index_information()  # get a list of all indexes on that collection.
-    # Loop through the indexes of the collection.
-    constraints = []
-    violated_constraints = []
-    for index in index_info.keys():  # Loop through the list of index names.
-        # see if the index is unique.  If not, we're not interested in using it.
-        # _id_ does not have a property named unique since _id_ is ALWAYS unique.
-        # Normally, _id_ is assigned by MongoDB, but the user COULD use that for a descriptive
-        # attribute, which COULD mean that there is a document with that _id_ value already.
-        if index == '_id_' or index_info[index]['unique']:
-            # harvest the list of column names from this index.
-            columns = [col[0] for col in index_info[index]['key']]
-            # add the name of the index & the column list to our constraints list of dictionaries.
-            constraints.append({'name': index, 'columns': columns})
-    for constraint in constraints:
-        # What happens if there are no unique indexes at all?
-        filters = {}  # The attribute/value pairs that we're going to search by
-        for column in constraint['columns']:
-            # now I have to convert from the column name to the attribute name.
-            attribute_name = get_attr_from_column(cls, column)
-            # Add the next key=value pair to our list of filters.
-            # MongoEngine requires that the '.' be replaced by a __ in the field reference.
-            field_name = attribute_name.replace('.', '__')
-            filters[field_name] = extract_attr(instance, attribute_name)  # instance[attribute_name]
-        # count the number of rows that meet those criteria.
-        if cls.objects(**filters).count() == 1:
-            # there is a document in the collection that matches the supplied instance on all attributes
-            # of this uniqueness constraint.  So we have another uniqueness constraint violation.
-            violated_constraints.append(constraint)
+    constraints, query, projection = uniqueness_query(instance)
+    # What happens if there are no unique indexes at all?  Then nothing can be violated.
+    if query is None:
+        return []
+    found = list(instance.__class__._get_collection().find(query, projection))
+    violated_constraints = violations(constraints, found)
     # If the returned list of violated constraints == [], we know that we are good to insert this object.
     return violated_constraints
+
+
+def duplicate_key_constraints(cls, details: dict) -> list:
+    """
+    Map a duplicate key error from the server back to the uniqueness constraint that it broke, in
+    the same form that unique_general returns.  The server gives the columns of the index in the
+    keyPattern of the error, and older servers only give the name of the index in the message.
+    :param cls:     The MongoEngine Document class that we were inserting into.
+    :param details: The details of a DuplicateKeyError, or one of the writeErrors of a BulkWriteError.
+    :return:        A list with the one {'name', 'columns'} constraint that was violated, or an empty
+                    list if the error does not match any unique index that we know of.
+    """
+    details = details or {}
+    key_pattern = list((details.get('keyPattern') or {}).keys())
+    message = details.get('errmsg') or ''
+    for constraint in get_unique_indexes(cls):
+        if constraint['columns'] == key_pattern or f'index: {constraint["name"]} ' in message:
+            return [{'name': constraint['name'], 'columns': constraint['columns']}]
+    return []
+
+
+def insert_unique(instance) -> list:
+    """
+    Insert a new document without checking its uniqueness constraints first.  The unique indexes
+    are the real guard anyway, and the check before the insert is both an extra round trip and a
+    race with anyone else inserting the same key.  So this just inserts, and if the server says
+    that the insert broke a unique index, that is turned into the same violation that
+    unique_general would have reported.  The server stops at the first index that it finds
+    violated, so at most one constraint comes back, where unique_general would list them all.
+    :param instance:    The new MongoEngine Document instance.  If it goes in, its pk is set.
+    :return:            The list of violated uniqueness constraints, usually just the one.  Empty
+                        means that the instance was inserted.
+    :raises ValidationError:    If the instance breaks a rule on its class, just as save() would.
+    """
+    cls = instance.__class__
+    instance.validate()
+    try:
+        result = cls._get_collection().insert_one(instance.to_mongo())
+    except DuplicateKeyError as dke:
+        violated_constraints = duplicate_key_constraints(cls, dke.details)
+        if len(violated_constraints) == 0:
+            # The error did not say which index it was.  Only now, on the way out, is it worth the
+            # query to find out.
+            violated_constraints = unique_general(instance)
+        if len(violated_constraints) == 0:
+            raise
+        return violated_constraints
+    instance.pk = result.inserted_id
+    instance._created = False
+    instance._clear_changed_fields()
+    return []
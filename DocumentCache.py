@@ -0,0 +1,236 @@
+"""
+Created on 10/17/2026
+A bounded, in-process cache of documents that are read far more often than they change, like the
+products in the catalog during order entry.  Each cached document can be found both by its _id and
+by the key of one of its unique indexes.  The cache evicts the least recently used document once it
+is full, and never hands out a document that has been cached for longer than its time to live.
+
+The cache is read-through: fetch and fetch_by_key go to the database on a miss.  Nothing here
+notices changes on its own, so whatever changes a cached field of a cached class in the database
+has to call invalidate for the documents that it touched.  The fields that change all the time,
+like the stock of a product, are left out of the cache altogether, so that changing them does not
+throw the document out of the cache.
+
+The cache keeps the raw documents, and every lookup builds a new instance from one, so a caller
+can change the instance that it gets without changing what the next caller gets.  The fields that
+are left out come back as None; see left_out.  That makes the instances read only: a class that is
+cached refuses to save or update an instance that has fields left out, and code that is going to
+change a document reads it from the database instead.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from functools import reduce
+
+from ConstraintUtilities import get_unique_indexes, extract_attr, column_value
+
+
+class DocumentCache:
+    """An LRU cache with a time to live, of the documents of one class."""
+
+    def __init__(self, cls, index_name: str, max_size: int = 1000, ttl: float = 300.0, exclude: [str] = ()):
+        """
+        :param cls:         The MongoEngine Document class to cache.
+        :param index_name:  The unique index whose key the documents can also be found by.
+        :param max_size:    The most documents to keep.
+        :param ttl:         How many seconds a document stays good for after it was read.
+        :param exclude:     The attributes to leave out of the cached documents, the ones that change
+                            too often to be worth caching.  They must not be in index_name.
+        """
+        self.cls = cls
+        self.index_name = index_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.exclude = tuple(exclude)
+        self.excluded_columns = {cls._fields[attribute].db_field for attribute in self.exclude}
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # _id --> (raw document, expiry time, key), least recently used first.
+        self.keys = {}                  # key --> _id
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+    def key_index(self) -> dict:
+        # Looked up each time rather than kept, since the index cache can be invalidated and reloaded.
+        return [index for index in get_unique_indexes(self.cls) if index['name'] == self.index_name][0]
+
+    def key_of(self, values) -> tuple:
+        """
+        :param values:  A document, or a dictionary of the values of the key attributes by name.
+        :return:        The key of that document on index_name, as the values stored in the database.
+        """
+        key = []
+        for attribute_name in self.key_index()['attributes']:
+            if isinstance(values, dict):
+                value = values[attribute_name]
+            else:
+                value = reduce(getattr, attribute_name.split('.'), values)
+            key.append(extract_attr(self.cls, attribute_name).to_mongo(value))
+        return tuple(key)
+
+    def projection(self) -> dict:
+        # Just the fields that are left out, so that everything else, including any new field, is cached.
+        return {column: 0 for column in self.excluded_columns}
+
+    def instance(self, raw: dict):
+        """
+        :param raw: A cached raw document.
+        :return:    A new instance of the class built from it, with None for the fields left out.
+        """
+        document = self.cls._from_son(dict(copy.deepcopy(raw), **{column: None for column in self.excluded_columns}))
+        document._left_out = self.exclude
+        return document
+
+    def get(self, document_id):
+        """
+        :param document_id: The _id of the document.
+        :return:            A new instance of the cached document, or None if it is not cached (or no
+                            longer good).
+        """
+        with self.lock:
+            entry = self.entries.get(document_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(document_id)
+                self.hits += 1
+                raw = entry[0]
+            else:
+                if entry is not None:
+                    self.remove(document_id)
+                self.misses += 1
+                return None
+        return self.instance(raw)
+
+    def get_by_key(self, key: tuple):
+        with self.lock:
+            document_id = self.keys.get(key)
+        return self.get(document_id) if document_id is not None else self.miss()
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, raw: dict):
+        """
+        Cache a document, evicting the least recently used one if the cache is full.
+        :param raw:     The raw (pymongo) document, as read from the database with projection().
+        :return:        A new instance of the document.
+        """
+        raw = {column: value for column, value in raw.items() if column not in self.excluded_columns}
+        key = tuple(column_value(raw, column) for column in self.key_index()['columns'])
+        with self.lock:
+            self.remove(raw['_id'])
+            self.entries[raw['_id']] = (raw, time.monotonic() + self.ttl, key)
+            self.keys[key] = raw['_id']
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+        return self.instance(raw)
+
+    def remove(self, document_id):
+        # Only call this while holding the lock.
+        entry = self.entries.pop(document_id, None)
+        if entry is not None and self.keys.get(entry[2]) == document_id:
+            del self.keys[entry[2]]
+        return entry is not None
+
+    def fetch(self, document_id):
+        """
+        Read-through lookup by _id.
+        :param document_id: The _id of the document.
+        :return:            The document, from the cache if possible, or None if there is no such document.
+        """
+        document = self.get(document_id)
+        if document is None:
+            raw = self.cls._get_collection().find_one({'_id': document_id}, self.projection())
+            if raw is not None:
+                document = self.put(raw)
+        return document
+
+    def fetch_by_key(self, values: dict):
+        """
+        Read-through lookup by the unique key.
+        :param values:  The value of each attribute of index_name, by attribute name.
+        :return:        The document, from the cache if possible, or None if there is no such document.
+        """
+        key = self.key_of(values)
+        document = self.get_by_key(key)
+        if document is None:
+            raw = self.cls._get_collection().find_one(dict(zip(self.key_index()['columns'], key)), self.projection())
+            if raw is not None:
+                document = self.put(raw)
+        return document
+
+    def invalidate(self, *document_ids):
+        """
+        Drop documents that have changed in the database.  Ids that are not cached are ignored.
+        :param document_ids:    The _ids of the changed documents.
+        :return:                None
+        """
+        with self.lock:
+            for document_id in document_ids:
+                if self.remove(document_id):
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else None,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+# The cache for each class that has one.  Code that changes documents calls invalidate with the
+# class, so it does not need to know whether that class is cached.
+caches: dict = {}
+
+
+def register_cache(cache: DocumentCache) -> DocumentCache:
+    caches[cache.cls] = cache
+    return cache
+
+
+def cache_for(cls) -> DocumentCache:
+    """
+    :param cls: A MongoEngine Document class.
+    :return:    The cache of that class, or None if it is not cached.
+    """
+    return caches.get(cls)
+
+
+def left_out(document) -> tuple:
+    """
+    :param document:    A MongoEngine Document instance.
+    :return:            The attributes that it does not have because it came out of a cache.
+    """
+    return document.__dict__.get('_left_out', ())
+
+
+def cached_columns_changed(cls, columns) -> bool:
+    """
+    :param cls:     The MongoEngine Document class.
+    :param columns: The (possibly dotted) columns that changed in one of its documents.
+    :return:        False if cls has a cache and none of those columns are in it.
+    """
+    cache = caches.get(cls)
+    return cache is None or any(column.split('.')[0] not in cache.excluded_columns for column in columns)
+
+
+def invalidate(cls, *document_ids):
+    """
+    Drop changed documents from the cache of their class, if it has one.
+    :param cls:             The MongoEngine Document class.
+    :param document_ids:    The _ids of the documents that changed.
+    :return:                None
+    """
+    cache = caches.get(cls)
+    if cache is not None:
+        cache.invalidate(*document_ids)
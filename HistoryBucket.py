@@ -0,0 +1,201 @@
+"""
+Created on 10/17/2026
+The price history of a product and the status history of an order are arrays that only ever
+grow.  When a document has a history window (Product.PRICE_HISTORY_WINDOW or
+Order.STATUS_HISTORY_WINDOW), only the latest entries stay embedded in the document, and the
+older ones are moved out into a bucket collection, one bucket document per owner per month.
+"""
+from bisect import bisect_right
+from datetime import datetime
+
+from mongoengine import *
+from pymongo import UpdateOne, ReturnDocument
+
+
+class HistoryBucket(Document):
+    """
+    One month's worth of history entries that have been moved out of a document.  This is
+    abstract; each concrete bucket class supplies the reference to its owner (OWNER names
+    that attribute), the entries list of the right EmbeddedDocument type, and the name of the
+    date attribute of that EmbeddedDocument (DATE_ATTRIBUTE).
+    """
+    OWNER: str = None
+    DATE_ATTRIBUTE: str = None
+
+    bucketStart = DateTimeField(db_field='bucket_start', required=True)
+
+    meta = {'abstract': True}
+
+    @staticmethod
+    def bucket_start(date: datetime) -> datetime:
+        """
+        Return the start of the bucket that an entry with the given date goes into.
+        :param date:    The date of the history entry.
+        :return:        Midnight on the first day of that month.
+        """
+        return datetime(date.year, date.month, 1)
+
+    @classmethod
+    def columns(cls) -> (str, str, str, str):
+        """
+        :return:    The physical names of the owner, bucket start and entries columns, plus the
+                    name of the date column within each entry.
+        """
+        date_column = cls._fields['entries'].field.document_type._fields[cls.DATE_ATTRIBUTE].db_field
+        return (cls._fields[cls.OWNER].db_field, cls._fields['bucketStart'].db_field,
+                cls._fields['entries'].db_field, date_column)
+
+    @classmethod
+    def archive(cls, owner_id, entries: [dict]):
+        """
+        Copy history entries into their buckets.  The entries are grouped by month, and each
+        month is one upsert that appends to that month's bucket, all in one bulk_write.  The
+        entries are added with $addToSet, so archiving the same entries again, after a push that
+        did not get as far as trimming them, does not store them twice.
+        :param owner_id:    The _id of the document that the entries came out of.
+        :param entries:     The raw (pymongo) entries, oldest first.
+        :return:            None
+        """
+        requests = cls.archive_requests(owner_id, entries)
+        if len(requests) > 0:
+            cls._get_collection().bulk_write(requests, ordered=True)
+
+    @classmethod
+    def archive_requests(cls, owner_id, entries: [dict]) -> [UpdateOne]:
+        """
+        Build the upserts for archive, one per month, without running them.
+        :param owner_id:    The _id of the document that the entries came out of.
+        :param entries:     The raw (pymongo) entries, oldest first.
+        :return:            The list of UpdateOne requests for bulk_write.
+        """
+        owner_column, start_column, entries_column, date_column = cls.columns()
+        by_bucket = {}
+        for entry in entries:
+            by_bucket.setdefault(cls.bucket_start(entry[date_column]), []).append(entry)
+        return [UpdateOne({owner_column: owner_id, start_column: start},
+                          {'$addToSet': {entries_column: {'$each': bucket_entries}}},
+                          upsert=True)
+                for start, bucket_entries in by_bucket.items()]
+
+    @classmethod
+    def owner_filter(cls, owner_id) -> dict:
+        """
+        :param owner_id:    The _id of the document whose history we want.
+        :return:            The filter for all of the buckets of that document.
+        """
+        return {cls.columns()[0]: owner_id}
+
+    @classmethod
+    def history(cls, owner_id, before: datetime = None):
+        """
+        Page back through the archived history of one owner, newest entry first.  The buckets are
+        read from a cursor one at a time as the caller asks for more, so nothing is read that the
+        caller does not use.
+        :param owner_id:    The _id of the document whose history we want.
+        :param before:      Only return the entries strictly before this date, if given.
+        :return:            A generator of the EmbeddedDocument entries.
+        """
+        query = {cls.OWNER: owner_id}
+        if before is not None:
+            query['bucketStart__lte'] = before
+        for bucket in cls.objects(**query).order_by('-bucketStart'):
+            for entry in reversed(bucket.entries):
+                if before is None or getattr(entry, cls.DATE_ATTRIBUTE) < before:
+                    yield entry
+
+    @classmethod
+    def latest_at(cls, owner_id, when: datetime):
+        """
+        Find the archived entry that was in effect at a given moment: the last one dated at or
+        before it.  Usually that is in the bucket for the month of the given moment, and only if
+        that month has nothing early enough do we have to go back to an earlier bucket.
+        :param owner_id:    The _id of the document whose history we want.
+        :param when:        The moment in time that we want the entry for.
+        :return:            The EmbeddedDocument entry, or None if the history starts after when.
+        """
+        for bucket in cls.objects(**{cls.OWNER: owner_id, 'bucketStart__lte': when}).order_by('-bucketStart'):
+            dates = [getattr(entry, cls.DATE_ATTRIBUTE) for entry in bucket.entries]
+            position = bisect_right(dates, when)
+            if position > 0:
+                return bucket.entries[position - 1]
+        return None
+
+    @classmethod
+    def latest_at_many(cls, owner_id, moments: [datetime]) -> list:
+        """
+        latest_at for many moments in the history of one owner.  One query reads the buckets from
+        the month of the earliest moment to the month of the latest, oldest first, and each moment
+        is answered with a binary search over their entries.  Only a moment that has nothing at or
+        before it in those months needs one more query, for the last entry before them.
+        :param owner_id:    The _id of the document whose history we want.
+        :param moments:     The moments in time that we want the entries for.
+        :return:            The EmbeddedDocument entry (or None) for each moment, in the same order.
+        """
+        if len(moments) == 0:
+            return []
+        first_month = cls.bucket_start(min(moments))
+        entries = []
+        for bucket in cls.objects(**{cls.OWNER: owner_id, 'bucketStart__gte': first_month,
+                                     'bucketStart__lte': max(moments)}).order_by('bucketStart'):
+            entries.extend(bucket.entries)
+        dates = [getattr(entry, cls.DATE_ATTRIBUTE) for entry in entries]
+        positions = [bisect_right(dates, when) for when in moments]
+        earlier = None
+        if 0 in positions:
+            # A bucket is only made to hold an entry, so the last bucket before those months ends
+            # with the latest entry before them.
+            bucket = cls.objects(**{cls.OWNER: owner_id, 'bucketStart__lt': first_month}) \
+                .order_by('-bucketStart').fields(slice__entries=-1).first()
+            earlier = bucket.entries[-1] if bucket and bucket.entries else None
+        return [entries[position - 1] if position > 0 else earlier for position in positions]
+
+    @classmethod
+    def push(cls, owner_cls, query: dict, update: dict, window: int) -> bool:
+        """
+        Append one history entry to a document.  With no window, this is just the update_one.  With
+        a window, the update hands back the history as it is after the push, and if that is longer
+        than the window, the entries that no longer fit are first archived into their buckets and
+        only then $pulled out of the document.  The $pull names exactly the entries that were
+        archived, so a crash in between leaves them in both places rather than in neither, and the
+        next push archives them again (harmlessly) and trims them.
+        :param owner_cls:   The Document class that owns the history, Order or Product.
+        :param query:       The filter that the owning document must match.
+        :param update:      A {'$push': {history column: entry}} update, possibly with other operators.
+        :param window:      The number of entries to keep embedded, or None to keep all of them.
+        :return:            True if the document matched the query and got the new entry.
+        """
+        collection = owner_cls._get_collection()
+        if not window:
+            return collection.update_one(query, update).matched_count > 0
+        history = next(iter(update['$push']))
+        # The history is trimmed after every push, so this is at most window + 1 entries, plus any
+        # that a push before this one did not get to trim.
+        after = collection.find_one_and_update(query, update, projection={history: 1},
+                                               return_document=ReturnDocument.AFTER)
+        if after is None:
+            return False
+        spilled = cls.spilled(after, history, window)
+        if len(spilled) > 0:
+            cls.archive(after['_id'], spilled)
+            collection.update_one(*cls.trim(after['_id'], history, spilled))
+        return True
+
+    @staticmethod
+    def spilled(after: dict, history: str, window: int) -> [dict]:
+        """
+        :param after:   The owning document as it is after the push.
+        :return:        The entries at the front of the history that no longer fit in the window.
+        """
+        entries = after.get(history, [])
+        return entries[:max(0, len(entries) - window)]
+
+    @staticmethod
+    def trim(owner_id, history: str, spilled: [dict]) -> (dict, dict):
+        """
+        Build the filter and the update that take archived entries out of the embedded history.
+        :param owner_id:    The _id of the owning document.
+        :param history:     The history column.
+        :param spilled:     The raw entries that have been archived.
+        :return:            A (filter, update) tuple for update_one.
+        """
+        return {'_id': owner_id}, {'$pull': {history: {'$in': spilled}}}
@@ -0,0 +1,100 @@
+"""
+Created on 10/17/2026
+Utilities for listing every document in a collection without loading the whole collection into
+memory.  The documents are read a page at a time, and each page picks up where the last one left
+off by its key values (keyset pagination), rather than skipping over the pages already read.
+Only the columns being displayed are brought back from the database.
+"""
+from ConstraintUtilities import get_unique_indexes, column_value
+
+
+def index_columns(cls, index_name: str) -> [str]:
+    """
+    Return the column names of one of the unique indexes on the collection behind cls.
+    :param cls:         The MongoEngine Document class.
+    :param index_name:  The name of the unique index, for instance orders_pk.
+    :return:            The list of column names in that index.
+    """
+    return [index for index in get_unique_indexes(cls) if index['name'] == index_name][0]['columns']
+
+
+def after_key(columns: [str], values: list) -> dict:
+    """
+    Build the filter for "everything after this key" in the sort order of the key columns.  For
+    the key (a, b) that is: a > va, or a = va and b > vb.
+    :param columns:     The key columns, in sort order.
+    :param values:      The values of those columns in the last document that we read.
+    :return:            A filter for find().
+    """
+    alternatives = []
+    for position, column in enumerate(columns):
+        alternative = {columns[previous]: values[previous] for previous in range(position)}
+        alternative[column] = {'$gt': values[position]}
+        alternatives.append(alternative)
+    return {'$or': alternatives}
+
+
+def is_unique_key(cls, columns: [str]) -> bool:
+    """
+    Tell whether a set of columns is enough to tell every document apart, that is whether it
+    includes all of the columns of one of the unique indexes (_id_ among them).
+    :param cls:         The MongoEngine Document class.
+    :param columns:     The column names.
+    :return:            True if no two documents can have the same values in those columns.
+    """
+    return any(set(index['columns']) <= set(columns) for index in get_unique_indexes(cls))
+
+
+def keyset_pages(cls, projection: dict, key_columns: [str] = None, page_size: int = 50, batch_size: int = None,
+                 query: dict = None):
+    """
+    Read through all the documents of a collection, one page at a time, in key order.
+    :param cls:         The MongoEngine Document class whose collection to read.
+    :param projection:  The columns to bring back, in the pymongo projection format.
+    :param key_columns: The columns to page by, normally those of a unique index, so that the sort
+                        is the order of that index.  If they are not unique, _id is added at the
+                        end as a tie breaker, and then only an index that ends in _id can give
+                        that order without sorting in memory.
+    :param page_size:   The number of documents per page.
+    :param batch_size:  The number of documents per round trip from the server cursor.  Defaults
+                        to the page size.
+    :param query:       Only list the documents that match this filter, if given.
+    :return:            A generator of pages, each a list of raw (pymongo) documents.
+    """
+    columns = list(key_columns or [])
+    if not is_unique_key(cls, columns):
+        columns = [column for column in columns if column != '_id'] + ['_id']
+    # The key columns have to come back in the documents, or we could not tell where a page ended.
+    fields = dict(projection)
+    fields.update({column: 1 for column in columns})
+    collection = cls._get_collection()
+    base_query = query or {}
+    page_query = base_query
+    while True:
+        cursor = collection.find(page_query, fields) \
+            .sort([(column, 1) for column in columns]) \
+            .limit(page_size) \
+            .batch_size(batch_size or page_size)
+        page = list(cursor)
+        if len(page) == 0:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after = after_key(columns, [column_value(page[-1], column) for column in columns])
+        page_query = {'$and': [base_query, after]} if base_query else after
+
+
+def show_pages(pages, render, prompt: bool = True):
+    """
+    Print a listing one page at a time.  Only the page being printed is in memory.
+    :param pages:   A generator of pages from keyset_pages.
+    :param render:  A function that takes a page and returns a list of lines to print.
+    :param prompt:  If True, ask the user before going on to the next page.
+    :return:        None
+    """
+    for page in pages:
+        for line in render(page):
+            print(line)
+        if prompt and input('Press enter for more, or q to quit --> ').strip().lower() == 'q':
+            return
@@ -8,6 +8,9 @@ from Status import Status
 from mongoengine import *
 from datetime import datetime
 from StatusChange import StatusChange
+from ReferenceUtilities import reference_id, reference_ids, fetch_by_ids, forget_change, ItemIndex
+from StatusHistoryBucket import StatusHistoryBucket
+from pymongo import UpdateOne
 # from OrderItemProduct import OrderItem
 
 
@@ -23,30 +26,120 @@ class Order(Document):
     # there already is a delete rule from OrderItem to Order, and I cannot have circular delete
     # rules.  The delete rule to protect Order from losing Order Items will be in main.py.
     orderItems = ListField(ReferenceField('OrderItem'))
+    # A copy of the status and date of the latest entry in statusHistory.  Every change of status
+    # sets these along with the $push, so "every order that is on hold" is an index lookup on
+    # orders_current_status instead of a look at the end of every order's history.
+    currentStatus = EnumField(Status, db_field='current_status')
+    currentStatusDate = DateTimeField(db_field='current_status_date')
+
+    # How many of the latest status changes stay embedded in the order.  The older ones are moved
+    # out to the status_history_buckets collection by push_status.  None keeps the whole history.
+    STATUS_HISTORY_WINDOW: int = None
 
     meta = {'collection': 'orders',
             'indexes': [
-                {'unique': True, 'fields': ['customerName', 'orderDate'], 'name': 'orders_pk'}
+                {'unique': True, 'fields': ['customerName', 'orderDate'], 'name': 'orders_pk'},
+                # _id at the end so that orders_in_status can page by (date, _id) straight off the index.
+                {'fields': ['currentStatus', 'currentStatusDate', 'id'], 'name': 'orders_current_status'}
             ]}
 
     def change_status(self, new_status: StatusChange):
         """
         Every time the status changes for the order, we add another instance of StatusChange to
-        the history list of status changes.
+        the history list of status changes.  This only changes the order in memory; for an order
+        that is already in the database, push_status appends the change atomically instead.
         :param new_status:  An instance of StatusChange representing the latest status change.
         :return:            None
         """
         if self.statusHistory:
-            current_status = self.statusHistory[-1]
-            if current_status.status == new_status.status:
-                raise ValueError('It is already in this status.')
-            if current_status.statusChangeDate >= new_status.statusChangeDate:
-                raise ValueError('New status must be later than the latest status change.')
-            if new_status.statusChangeDate > datetime.utcnow():
-                raise ValueError('The status change cannot occur in the future.')
+            error = Order.status_change_error(self.statusHistory[-1], new_status)
+            if error:
+                raise ValueError(error)
             self.statusHistory.append(new_status)
         else:
             self.statusHistory = [new_status]   # This is the first status "change".
+        self.currentStatus = new_status.status
+        self.currentStatusDate = new_status.statusChangeDate
+
+    @staticmethod
+    def status_change_error(current_status: StatusChange, new_status: StatusChange):
+        """
+        Check a new status against the latest one in the history.
+        :param current_status:  The latest StatusChange of the order.
+        :param new_status:      The StatusChange that we want to add.
+        :return:                The reason why the new status is not allowed, or None if it is.
+        """
+        if current_status.status == new_status.status:
+            return 'It is already in this status.'
+        if current_status.statusChangeDate >= new_status.statusChangeDate:
+            return 'New status must be later than the latest status change.'
+        if new_status.statusChangeDate > datetime.utcnow():
+            return 'The status change cannot occur in the future.'
+        return None
+
+    @classmethod
+    def status_append(cls, order_id, new_status: StatusChange) -> (dict, dict):
+        """
+        Build the filter and the update that append a status change to an order, and set its
+        currentStatus and currentStatusDate to match, in one atomic update_one.  The filter only
+        matches if the latest entry in the history has a different status and an earlier date,
+        and the new date is not in the future, which are the same rules that change_status
+        enforces, only applied by the server.
+        :param order_id:    The _id of the order.
+        :param new_status:  The StatusChange to append.
+        :return:            A (filter, update) tuple for update_one.
+        """
+        history = cls._fields['statusHistory'].db_field
+        entry = new_status.to_mongo()
+        status_column = StatusChange._fields['status'].db_field
+        date_column = StatusChange._fields['statusChangeDate'].db_field
+        # On an empty history $arrayElemAt comes back missing, which is != any status and < any date.
+        query = {'_id': order_id,
+                 '$expr': {'$and': [
+                     {'$ne': [{'$arrayElemAt': [f'${history}.{status_column}', -1]}, entry[status_column]]},
+                     {'$lt': [{'$arrayElemAt': [f'${history}.{date_column}', -1]}, entry[date_column]]},
+                     {'$lte': [entry[date_column], '$$NOW']}]}}
+        return query, {'$push': {history: entry},
+                       '$set': {cls._fields['currentStatus'].db_field: entry[status_column],
+                                cls._fields['currentStatusDate'].db_field: entry[date_column]}}
+
+    @classmethod
+    def push_status(cls, order_id, new_status: StatusChange):
+        """
+        Append a status change to an order in the database without loading the order first.  This
+        is one update_one with a $push, so it does not resend the whole history, and it cannot lose
+        a status change made by someone else between our read and our write.
+        :param order_id:    The _id of the order.
+        :param new_status:  The StatusChange to append.
+        :return:            None
+        :raises ValueError: If the order does not exist, or the new status breaks the rules.
+        """
+        query, update = cls.status_append(order_id, new_status)
+        if not StatusHistoryBucket.push(cls, query, update, cls.STATUS_HISTORY_WINDOW):
+            # Only on failure do we go back and read the latest status, to say why.
+            history = cls._fields['statusHistory'].db_field
+            latest = cls._get_collection().find_one({'_id': order_id}, {history: {'$slice': -1}})
+            raise ValueError(cls.push_status_error(latest, new_status))
+
+    @classmethod
+    def push_status_error(cls, latest: dict, new_status: StatusChange) -> str:
+        """
+        Explain why the filter from status_append did not match.
+        :param latest:      The order as read back with only the latest entry of its status history
+                            ({history column: {'$slice': -1}}), or None if there is no such order.
+        :param new_status:  The StatusChange that could not be appended.
+        :return:            The reason, for the ValueError.
+        """
+        history = cls._fields['statusHistory'].db_field
+        if latest is None:
+            return 'There is no such order.'
+        if latest.get(history):
+            error = cls.status_change_error(StatusChange._from_son(latest[history][-1]), new_status)
+        elif new_status.statusChangeDate > datetime.utcnow():
+            error = 'The status change cannot occur in the future.'
+        else:
+            error = None
+        return error or 'The order changed while updating it, try again.'
 
     def get_current_status(self) -> Status:
         """
@@ -54,11 +147,92 @@ class Order(Document):
         :return: The current status of the order.  Note, if there is no status for
         this order, then this method will return a None.
         """
-        if self.statusHistory:
+        if self.currentStatus is not None:
+            return self.currentStatus
+        elif self.statusHistory:
             return self.statusHistory[-1].status
         else:
             return None
 
+    @classmethod
+    def current_status(cls, order_id) -> Status:
+        """
+        Get the current status of an order straight from the database, reading only the latest
+        entry of its status history rather than the whole order.
+        :param order_id:    The _id of the order.
+        :return:            The current status of the order, or None if it has none.
+        """
+        history = cls._fields['statusHistory'].db_field
+        current = cls._fields['currentStatus'].db_field
+        latest = cls._get_collection().find_one({'_id': order_id}, {current: 1, history: {'$slice': -1}, '_id': 0})
+        if latest and latest.get(current):
+            return Status(latest[current])
+        elif latest and latest.get(history):
+            return StatusChange._from_son(latest[history][-1]).status
+        else:
+            return None
+
+    @classmethod
+    def orders_in_status(cls, status: Status, since: datetime = None, page_size: int = 50, projection: dict = None):
+        """
+        Page through the orders that are currently in a status, oldest status change first, using
+        the orders_current_status index for both the filter and the sort.
+        :param status:      The status that we want the orders in.
+        :param since:       Only the orders that went into that status at or after this date, if given.
+        :param page_size:   The number of orders per page.
+        :param projection:  The columns to bring back, by default the customer, order date, clerk,
+                            and the current status and its date.
+        :return:            A generator of pages, each a list of raw (pymongo) documents.
+        """
+        # Imported here because ListingUtilities goes through ConstraintUtilities to the models.
+        from ListingUtilities import keyset_pages
+        current, current_date = cls._fields['currentStatus'].db_field, cls._fields['currentStatusDate'].db_field
+        query = {current: status.value}
+        if since is not None:
+            query[current_date] = {'$gte': since}
+        if projection is None:
+            projection = {cls._fields[attribute].db_field: 1 for attribute in
+                          ('customerName', 'orderDate', 'soldBy', 'currentStatus', 'currentStatusDate')}
+        return keyset_pages(cls, projection, [current_date], page_size, query=query)
+
+    @classmethod
+    def backfill_current_status(cls, batch_size: int = 1000) -> int:
+        """
+        Fill in currentStatus and currentStatusDate for the orders that were stored before those
+        existed, from the latest entry of their status histories.  Only the orders that are missing
+        them are read, so once everything is filled in, this is one (indexed) query that finds nothing.
+        :param batch_size:  The number of orders to update per bulk_write.
+        :return:            The number of orders updated.
+        """
+        history = cls._fields['statusHistory'].db_field
+        current, current_date = cls._fields['currentStatus'].db_field, cls._fields['currentStatusDate'].db_field
+        status_column = StatusChange._fields['status'].db_field
+        date_column = StatusChange._fields['statusChangeDate'].db_field
+        collection = cls._get_collection()
+        updated = 0
+        requests = []
+        # An order with no history at all has nothing to fill in, so it is left out of the query.
+        for order in collection.find({current: None, f'{history}.0': {'$exists': True}},
+                                     {history: {'$slice': -1}}, batch_size=batch_size):
+            latest = order[history][-1]
+            requests.append(UpdateOne({'_id': order['_id']},
+                                      {'$set': {current: latest[status_column], current_date: latest[date_column]}}))
+            if len(requests) >= batch_size:
+                updated += collection.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if len(requests) > 0:
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+        return updated
+
+    def older_statuses(self):
+        """
+        Page back through the status changes that have been moved out of this order into the
+        status_history_buckets collection, newest first.
+        :return:    A generator of StatusChange instances.
+        """
+        before = self.statusHistory[0].statusChangeDate if self.statusHistory else None
+        return StatusHistoryBucket.history(self.pk, before)
+
     def __init__(self, customerName: str, orderDate: datetime, soldBy: str, *args, **values):
         """
         Create a new instance of an Order object
@@ -85,11 +259,46 @@ class Order(Document):
         :return: A string representation of the Order instance.
         """
         results = f'Order: Placed by - {self.customerName} placed on {self.orderDate} status: {self.get_current_status()}'
-        for orderItem in self.orderItems:
-            results = results + '\n\t' + f'Item: {orderItem.product}'
+        # Reading orderItem.product one item at a time costs a query per item, and then another one
+        # per product.  Instead, load all the items with one $in query, then all their products
+        # with one more, projected down to what we display.
+        item_class = self._fields['orderItems'].field.document_type
+        product_class = item_class._fields['product'].document_type
+        product_column = item_class._fields['product'].db_field
+        quantity_column = item_class._fields['quantity'].db_field
+        items = fetch_by_ids(item_class, reference_ids(self, 'orderItems'), {product_column: 1, quantity_column: 1})
+        code_column = product_class._fields['productCode'].db_field
+        name_column = product_class._fields['productName'].db_field
+        history_column = product_class._fields['priceHistory'].db_field
+        price_column = product_class._fields['priceHistory'].field.document_type._fields['newPrice'].db_field
+        products = fetch_by_ids(product_class, [item[product_column] for item in items.values()],
+                                {code_column: 1, name_column: 1, history_column: {'$slice': -1}})
+        for item_id in reference_ids(self, 'orderItems'):
+            item = items.get(item_id)
+            if item is None:
+                continue  # The item has been deleted out from under this order.
+            product = products.get(item[product_column], {})
+            latest_prices = product.get(history_column) or [{}]
+            results = results + '\n\t' + f'Item: Product code: {product.get(code_column)} ' \
+                                          f'Product Name: {product.get(name_column)} ' \
+                                          f'current price: {latest_prices[-1].get(price_column)} ' \
+                                          f'Qty: {item[quantity_column]}'
         return results
 
-    def add_item(self, item):
+    def item_index(self) -> ItemIndex:
+        """
+        Return the index over orderItems, keyed by the _id of the ordered product, building it
+        first if the list has changed out from under the index that we already have.  The keys
+        come from the raw product reference in each OrderItem, so nothing gets dereferenced.
+        :return:    The ItemIndex for this order's items.
+        """
+        index = self.__dict__.get('_item_index')
+        if index is None or not index.covers(self.orderItems):
+            index = ItemIndex(self.orderItems, lambda item: reference_id(item._data.get('product')))
+            self._item_index = index
+        return index
+
+    def add_item(self, item, atomic: bool = False):
         """
         Adds an item to the Order.  Note that the item argument is an instance of the
         OrderItem class, and as such has both the product that is ordered and
@@ -97,34 +306,46 @@ class Order(Document):
         same product.
         :param item:    An instance of OrderItem class to be added to this Order.  If
         an OrderItem    this Product is already in the order, this call is ignored.
+        :param atomic:  If True, the item is also added in the database right away with an
+                        $addToSet, and a later save() will not rewrite the orderItems list.
         :return:    None
         """
-        for already_ordered_item in self.orderItems:
-            if item.equals(already_ordered_item):
-                return  # Already in the order, don't add it.
+        index = self.item_index()
+        if index.find(item) is not None:
+            return  # Already in the order, don't add it.
         self.orderItems.append(item)
+        index.add(item)
+        if atomic:
+            Order.objects(pk=self.pk).update_one(add_to_set__orderItems=item)
+            forget_change(self, 'orderItems')
         # There is no need to update the OrderItem to point to this Order because the
         # constructor for OrderItem requires an Order and that constructor calls this
         # method.  Of course, the liability here is that someone could create an instance
         # of OrderItem withOUT using our constructor.  Argh.
 
-    def remove_item(self, item):
+    def remove_item(self, item, atomic: bool = True):
         """
         Removes a Product from the order.  Note that the item argument is an instance of the
         OrderItem class, but we ignore the quantity.
         :param item:    An instance of the OrderItem class that includes the Product that
                         we are removing from the order.  If this Product is not already in
                         the order, the call is ignored.
+        :param atomic:  If True (the default), the item is also removed in the database right
+                        away with a $pull, and a later save() will not rewrite the orderItems list.
+                        If False, the whole list is only written by the next save().
         :return:        None
         """
-        for already_ordered_item in self.orderItems:
-            # Check to see whether this next order item is the one that they want to delete
-            if item.equals(already_ordered_item):
-                # They matched on the Product, so they match.  For the remove_item use
-                # case, it doesn't really matter what quantity is called for.  I only used
-                # an instance of OrderItem here to be consistent with add_item.
-                self.orderItems.remove(already_ordered_item)
-                # At this point, the OrderItem object should be deleted since there is
-                # no longer a reference to it from Order.
-#                already_ordered_item.delete()
-                return
+        index = self.item_index()
+        # Check to see whether there is an order item for the same Product.  For the remove_item use
+        # case, it doesn't really matter what quantity is called for.  I only used
+        # an instance of OrderItem here to be consistent with add_item.
+        already_ordered_item = index.find(item)
+        if already_ordered_item is None:
+            return
+        del self.orderItems[index.position(already_ordered_item)]
+        index.remove(already_ordered_item)
+        if atomic:
+            Order.objects(pk=self.pk).update_one(pull__orderItems=already_ordered_item)
+            forget_change(self, 'orderItems')
+        # At this point, the OrderItem object should be deleted since there is
+        # no longer a reference to it from Order.
@@ -13,7 +13,8 @@ reverse_delete_rule.
 import mongoengine
 from mongoengine import *
 from Order import Order
-from Product import Product
+from Product import Product, product_cache
+from ReferenceUtilities import reference_id
 
 
 class OrderItem(Document):
@@ -55,10 +56,14 @@ class OrderItem(Document):
 
     def get_product(self):
         """
-        Return the identity of the product that this order item refers to.
+        Return the identity of the product that this order item refers to.  The product comes
+        out of the product cache when it can, rather than being dereferenced with a query.
         :return:    The identity of the ordered product.
         """
-        return self.product
+        value = self._data.get('product')
+        if isinstance(value, Product) or value is None:
+            return value
+        return product_cache.fetch(reference_id(value))
 
     def equals(self, other) -> bool:
         """
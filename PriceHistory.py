@@ -24,11 +24,15 @@ class PriceHistory(EmbeddedDocument):
     newPrice = Decimal128Field(db_field='new_price', min_value=0, precision=2) # should be same as buy price validation
     priceChangeDate = DateTimeField(db_field='price_change_date', required=True)
 
-    def __init__(self, price: str, date: datetime, *args, **kwargs):
-        """Constructor, made sure argument type is newPrice since its a mongoengine object type"""
+    def __init__(self, price: str = None, date: datetime = None, *args, **kwargs):
+        """Constructor, made sure argument type is newPrice since its a mongoengine object type.
+        The arguments are optional because MongoEngine builds the instances that it loads from the
+        database with keyword arguments (newPrice=, priceChangeDate=) instead."""
         super().__init__(*args, **kwargs)
-        self.newPrice = Decimal128(price)
-        self.priceChangeDate = date
+        if price is not None:
+            self.newPrice = Decimal128(price)
+        if date is not None:
+            self.priceChangeDate = date
 
     def __str__(self):
         return f'Price History Entry: New price: {self.newPrice}, on date: {self.priceChangeDate}'
@@ -0,0 +1,23 @@
+"""
+Created on 10/17/2026
+The older price changes of a product, once they no longer fit in the window of price history
+that stays embedded in the product.  See HistoryBucket.
+"""
+from mongoengine import *
+
+from HistoryBucket import HistoryBucket
+from PriceHistory import PriceHistory
+
+
+class PriceHistoryBucket(HistoryBucket):
+    """One month of price changes for one product, oldest first."""
+    OWNER = 'product'
+    DATE_ATTRIBUTE = 'priceChangeDate'
+
+    product = ReferenceField('Product', required=True)
+    entries = EmbeddedDocumentListField(PriceHistory, db_field='entries')
+
+    meta = {'collection': 'price_history_buckets',
+            'indexes': [
+                {'unique': True, 'fields': ['product', 'bucketStart'], 'name': 'price_history_buckets_pk'}
+            ]}
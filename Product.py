@@ -7,9 +7,22 @@ This handles the product class. Parent to OrderItem
 """
 
 from mongoengine import *
+from bisect import bisect_right
 from datetime import datetime
 from PriceHistory import PriceHistory
-from bson import Decimal128
+from bson import Decimal128, ObjectId
+from decimal import Decimal
+from ReferenceUtilities import reference_id, reference_ids, fetch_by_ids, forget_change, ItemIndex
+from PriceHistoryBucket import PriceHistoryBucket
+from DocumentCache import DocumentCache, register_cache, invalidate, left_out
+from pymongo import UpdateOne
+
+
+def as_decimal(value) -> Decimal:
+    """Return a price as a Decimal, whether it is a Decimal128, a Decimal, or a string."""
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return Decimal(value)
 
 
 class Product(Document):
@@ -26,6 +39,13 @@ class Product(Document):
 
     # The delete rule to protect Product from losing Order Items will be in main.py.
     orderItems = ListField(ReferenceField('OrderItem'))
+    # The tokens of the reserve_stock_many batches that are taking stock from this product right
+    # now.  Each batch pulls its own tokens off again, so this is empty between batches.
+    stockReservations = ListField(StringField(), db_field='stock_reservations')
+    # How many of the latest price changes stay embedded in the product.  The older ones are moved
+    # out to the price_history_buckets collection by push_price.  None keeps the whole history.
+    PRICE_HISTORY_WINDOW: int = None
+
     # Uniqueness constraint
     meta = {'collection': 'products',
             'indexes': [
@@ -49,20 +69,85 @@ class Product(Document):
     def change_price(self, new_price: PriceHistory):
         """
         Every time the price changes for the product, we add another instance of PriceHistory to
-        the history list of price changes.
+        the history list of price changes.  This only changes the product in memory; for a product
+        that is already in the database, push_price appends the change atomically instead.
         """
         if self.priceHistory:
-            current_price = self.priceHistory[-1] # get latest price
-            if current_price.newPrice == new_price.newPrice:
-                raise ValueError('This is already the newest price.')
-            if current_price.priceChangeDate >= new_price.priceChangeDate:
-                raise ValueError('New price must be later than the latest price change.')
-            if new_price.priceChangeDate > datetime.utcnow():
-                raise ValueError('The status change cannot occur in the future.')
+            error = Product.price_change_error(self.priceHistory[-1], new_price) # check against latest price
+            if error:
+                raise ValueError(error)
             self.priceHistory.append(new_price) # append to price history list
         else:
             self.priceHistory = [new_price]   # This is the first price "change".
 
+    @staticmethod
+    def price_change_error(current_price: PriceHistory, new_price: PriceHistory):
+        """
+        Check a new price against the latest one in the history.
+        Returns the reason why the new price is not allowed, or None if it is.
+        """
+        # Loaded prices come back as Decimal, new ones are still Decimal128, so compare them as Decimals.
+        if as_decimal(current_price.newPrice) == as_decimal(new_price.newPrice):
+            return 'This is already the newest price.'
+        if current_price.priceChangeDate >= new_price.priceChangeDate:
+            return 'New price must be later than the latest price change.'
+        if new_price.priceChangeDate > datetime.utcnow():
+            return 'The price change cannot occur in the future.'
+        return None
+
+    @classmethod
+    def price_append(cls, product_id, new_price: PriceHistory) -> (dict, dict):
+        """
+        Build the filter and the update that append a price change to a product in one atomic
+        update_one.  The filter applies the same rules as change_price on the server: a different
+        price than the latest one, a later date, and not in the future.
+        Returns a (filter, update) tuple for update_one.
+        """
+        history = cls._fields['priceHistory'].db_field
+        entry = new_price.to_mongo()
+        price_column = PriceHistory._fields['newPrice'].db_field
+        date_column = PriceHistory._fields['priceChangeDate'].db_field
+        # On an empty history $arrayElemAt comes back missing, which is != any price and < any date.
+        query = {'_id': product_id,
+                 '$expr': {'$and': [
+                     {'$ne': [{'$arrayElemAt': [f'${history}.{price_column}', -1]}, entry[price_column]]},
+                     {'$lt': [{'$arrayElemAt': [f'${history}.{date_column}', -1]}, entry[date_column]]},
+                     {'$lte': [entry[date_column], '$$NOW']}]}}
+        return query, {'$push': {history: entry}}
+
+    @classmethod
+    def push_price(cls, product_id, new_price: PriceHistory):
+        """
+        Append a price change to a product in the database without loading the product first.
+        One update_one with a $push: the history is not resent, and a concurrent price change
+        cannot be overwritten.  Raises ValueError if the product does not exist or if the new
+        price breaks the rules in price_change_error.
+        """
+        query, update = cls.price_append(product_id, new_price)
+        if not PriceHistoryBucket.push(cls, query, update, cls.PRICE_HISTORY_WINDOW):
+            # Only on failure do we go back and read the latest price, to say why.
+            history = cls._fields['priceHistory'].db_field
+            latest = cls._get_collection().find_one({'_id': product_id}, {history: {'$slice': -1}})
+            raise ValueError(cls.push_price_error(latest, new_price))
+        invalidate(cls, product_id)
+
+    @classmethod
+    def push_price_error(cls, latest: dict, new_price: PriceHistory) -> str:
+        """
+        Explain why the filter from price_append did not match.  latest is the product as read
+        back with only the latest entry of its price history, or None if there is no such product.
+        """
+        history = cls._fields['priceHistory'].db_field
+        if latest is None:
+            return 'There is no such product.'
+        if latest.get(history):
+            error = cls.price_change_error(PriceHistory._from_son(latest[history][-1]), new_price)
+        elif new_price.priceChangeDate > datetime.utcnow():
+            error = 'The price change cannot occur in the future.'
+        else:
+            error = None
+        return error or 'The product changed while updating it, try again.'
+
     def get_current_price(self) -> PriceHistory:
         """
         Get the current price of the product
@@ -73,55 +158,318 @@ class Product(Document):
             return None
 
 
+    @classmethod
+    def current_price(cls, product_id):
+        """
+        Get the current price of a product straight from the database, reading only the latest
+        entry of its price history rather than the whole product.
+        """
+        history = cls._fields['priceHistory'].db_field
+        latest = cls._get_collection().find_one({'_id': product_id}, {history: {'$slice': -1}, '_id': 0})
+        if latest and latest.get(history):
+            return PriceHistory._from_son(latest[history][-1]).newPrice
+        else:
+            return None
+
+    def price_at(self, when: datetime):
+        """
+        Get the price that was in effect at a given moment, the last price change at or before it.
+        change_price and push_price only ever append later dates, so the history is in date order
+        and we can binary search it.  Only a product with a history window can have older prices
+        archived, so only then does a moment before the embedded history go to the buckets.
+        Returns the price as a Decimal, or None if the product had no price yet at that moment.
+        """
+        position = bisect_right([entry.priceChangeDate for entry in self.priceHistory], when)
+        if position > 0:
+            return as_decimal(self.priceHistory[position - 1].newPrice)
+        if not Product.PRICE_HISTORY_WINDOW:
+            return None
+        entry = PriceHistoryBucket.latest_at(self.pk, when)
+        return as_decimal(entry.newPrice) if entry else None
+
+    @classmethod
+    def prices_at(cls, product_ids: list, timestamps: list) -> list:
+        """
+        Get the price that was in effect for many (product, moment) pairs at once, such as all the
+        line items that a revenue report needs to price.  The histories of all the distinct products
+        are read with one aggregation, which only brings back the entries that can answer one of the
+        moments: the last price change at or before the earliest moment, and the ones after that up
+        to the latest moment.  Each pair is then answered with a binary search.  With a history
+        window, the pairs older than the embedded history of a product go to the archive buckets,
+        with one query per product (see PriceHistoryBucket.latest_at_many).
+        Returns a list of prices as Decimals (or None) in the same order as the pairs.
+        :raises ValueError: If there is not one timestamp for each product _id.
+        """
+        if len(product_ids) != len(timestamps):
+            raise ValueError(f'There are {len(product_ids)} product ids but {len(timestamps)} timestamps.')
+        if len(product_ids) == 0:
+            return []
+        history = cls._fields['priceHistory'].db_field
+        price_column = PriceHistory._fields['newPrice'].db_field
+        date_column = PriceHistory._fields['priceChangeDate'].db_field
+        earliest, latest = min(timestamps), max(timestamps)
+        date = f'$$entry.{date_column}'
+
+        def entries_where(condition) -> dict:
+            return {'$filter': {'input': {'$ifNull': [f'${history}', []]}, 'as': 'entry', 'cond': condition}}
+        pipeline = [{'$match': {'_id': {'$in': list(set(product_ids))}}},
+                    {'$project': {'before': {'$slice': [entries_where({'$lte': [date, earliest]}), -1]},
+                                  'during': entries_where({'$and': [{'$gt': [date, earliest]},
+                                                                    {'$lte': [date, latest]}]})}}]
+        histories = {}  # product _id --> (list of dates, list of prices)
+        for document in cls._get_collection().aggregate(pipeline):
+            entries = document['before'] + document['during']
+            histories[document['_id']] = ([entry[date_column] for entry in entries],
+                                          [as_decimal(entry[price_column]) for entry in entries])
+        prices = []
+        archived = {}  # product _id --> [(position in prices, moment)] for the pairs that go to the buckets
+        for product_id, when in zip(product_ids, timestamps, strict=True):
+            if product_id not in histories:
+                prices.append(None)  # There is no such product.
+                continue
+            dates, product_prices = histories[product_id]
+            position = bisect_right(dates, when)
+            if position == 0 and cls.PRICE_HISTORY_WINDOW:
+                archived.setdefault(product_id, []).append((len(prices), when))
+            prices.append(product_prices[position - 1] if position > 0 else None)
+        for product_id, pairs in archived.items():
+            entries = PriceHistoryBucket.latest_at_many(product_id, [when for position, when in pairs])
+            for (position, when), entry in zip(pairs, entries, strict=True):
+                prices[position] = as_decimal(entry.newPrice) if entry else None
+        return prices
+
+    def older_prices(self):
+        """
+        Page back through the price changes that have been moved out of this product into the
+        price_history_buckets collection, newest first.
+        """
+        before = self.priceHistory[0].priceChangeDate if self.priceHistory else None
+        return PriceHistoryBucket.history(self.pk, before)
+
     def __str__(self):
         """
         Returns a string representation of the Product instance.
         Note: returns the price stored as instance of PriceHistory
         """
         results = f'Product code: {self.productCode} Product Name: {self.productName} current price: {self.get_current_price()}'
-        # print out orderitems that the product appears in
-        for orderItem in self.orderItems:
-            results = results + '\n\t' + f'Item: {orderItem.product}'
+        # print out orderitems that the product appears in.  The items are loaded with one $in query
+        # and their orders with one more, rather than dereferencing them one at a time.
+        item_class = self._fields['orderItems'].field.document_type
+        order_class = item_class._fields['order'].document_type
+        order_column = item_class._fields['order'].db_field
+        quantity_column = item_class._fields['quantity'].db_field
+        if 'orderItems' in left_out(self):
+            # A product out of the cache does not have its items, so read just their _ids.
+            items_column = self._fields['orderItems'].db_field
+            stored = Product._get_collection().find_one({'_id': self.pk}, {items_column: 1}) or {}
+            item_ids = stored.get(items_column, [])
+        else:
+            item_ids = reference_ids(self, 'orderItems')
+        items = fetch_by_ids(item_class, item_ids, {order_column: 1, quantity_column: 1})
+        customer_column = order_class._fields['customerName'].db_field
+        date_column = order_class._fields['orderDate'].db_field
+        orders = fetch_by_ids(order_class, [item[order_column] for item in items.values()],
+                              {customer_column: 1, date_column: 1})
+        for item_id in item_ids:
+            item = items.get(item_id)
+            if item is None:
+                continue  # The item has been deleted out from under this product.
+            order = orders.get(item[order_column], {})
+            results = results + '\n\t' + f'Item: Order placed by {order.get(customer_column)} ' \
+                                          f'on {order.get(date_column)} Qty: {item[quantity_column]}'
         return results
 
 
     """Handling order_items list, deletion and insertion. COPIED from Order"""
-    def add_item(self, item):
-        """
-        Adds an item to the Order.  Note that the item argument is an instance of the
-        OrderItem class, and as such has both the product that is ordered and
-        the quantity.  We cannot have more than one OrderItem for any Order for the
-        same product.
-        :param item:    An instance of OrderItem class to be added to this Order.  If
-        an OrderItem    this Product is already in the order, this call is ignored.
+    def item_index(self) -> ItemIndex:
+        """
+        Return the index over orderItems, keyed by the _id of the order that each item belongs to.
+        All the items of one product are for that same product, so unlike Order, the items of a
+        Product are told apart by their order.
+        """
+        index = self.__dict__.get('_item_index')
+        if index is None or not index.covers(self.orderItems):
+            index = ItemIndex(self.orderItems, lambda item: reference_id(item._data.get('order')))
+            self._item_index = index
+        return index
+
+    def add_item(self, item, atomic: bool = False):
+        """
+        Adds an item to the Product.  We cannot have more than one OrderItem for this Product
+        on the same Order.
+        :param item:    An instance of OrderItem class to be added to this Product.  If
+                        an OrderItem for that Order is already here, this call is ignored.
+        :param atomic:  If True, the item is also added in the database right away with an
+                        $addToSet, and a later save() will not rewrite the orderItems list.
         :return:    None
         """
-        for already_ordered_item in self.orderItems:
-            if item.equals(already_ordered_item):
-                return  # Already in the order, don't add it.
+        index = self.item_index()
+        if index.find(item) is not None:
+            return  # Already in the product, don't add it.
         self.orderItems.append(item)
-        # There is no need to update the OrderItem to point to this Order because the
-        # constructor for OrderItem requires an Order and that constructor calls this
-        # method.  Of course, the liability here is that someone could create an instance
-        # of OrderItem withOUT using our constructor.  Argh.
-
-    def remove_item(self, item):
-        """
-        Removes a Product from the order.  Note that the item argument is an instance of the
-        OrderItem class, but we ignore the quantity.
-        :param item:    An instance of the OrderItem class that includes the Product that
-                        we are removing from the order.  If this Product is not already in
-                        the order, the call is ignored.
+        index.add(item)
+        if atomic:
+            Product.objects(pk=self.pk).update_one(add_to_set__orderItems=item)
+            forget_change(self, 'orderItems')
+
+    def remove_item(self, item, atomic: bool = True):
+        """
+        Removes an OrderItem from the product's list of items.
+        :param item:    An instance of the OrderItem class for the Order that we are removing.
+                        If there is no item for that Order, the call is ignored.
+        :param atomic:  If True (the default), the item is also removed in the database right
+                        away with a $pull, and a later save() will not rewrite the orderItems list.
+                        If False, the whole list is only written by the next save().
         :return:        None
         """
-        for already_ordered_item in self.orderItems:
-            # Check to see whether this next order item is the one that they want to delete
-            if item.equals(already_ordered_item):
-                # They matched on the Product, so they match.  For the remove_item use
-                # case, it doesn't really matter what quantity is called for.  I only used
-                # an instance of OrderItem here to be consistent with add_item.
-                self.orderItems.remove(already_ordered_item)
-                # At this point, the OrderItem object should be deleted since there is
-                # no longer a reference to it from Order.
-#                already_ordered_item.delete()
-                return
+        index = self.item_index()
+        already_ordered_item = index.find(item)
+        if already_ordered_item is None:
+            return
+        del self.orderItems[index.position(already_ordered_item)]
+        index.remove(already_ordered_item)
+        if atomic:
+            Product.objects(pk=self.pk).update_one(pull__orderItems=already_ordered_item)
+            forget_change(self, 'orderItems')
+
+    @classmethod
+    def stock_reservation(cls, product_id, quantity: int) -> (dict, dict):
+        """
+        Build the filter and the update that take quantity units of a product out of stock.  The
+        filter only matches while there are at least that many in stock, so the check and the
+        decrement are one atomic update, and stock can never go negative.
+        Returns a (filter, update) tuple for update_one.
+        """
+        stock = cls._fields['quantityInStock'].db_field
+        return {'_id': product_id, stock: {'$gte': quantity}}, {'$inc': {stock: -quantity}}
+
+    @classmethod
+    def reserve_stock(cls, product_id, quantity: int) -> bool:
+        """
+        Take quantity units of a product out of stock for a new order item.  Returns False, and
+        leaves the stock alone, if there are not that many in stock or there is no such product.
+        """
+        query, update = cls.stock_reservation(product_id, quantity)
+        return cls._get_collection().update_one(query, update).matched_count > 0
+
+    @classmethod
+    def reserve_stock_many(cls, reservations: [tuple]) -> dict:
+        """
+        Take stock for many order items with one unordered bulk_write of the same conditional $inc
+        as reserve_stock, one per item, so that a product gives its stock to as many of its items
+        as it will cover.  A bulk_write only says how many of its updates matched, not which, so
+        each update also pushes a token of its own onto stockReservations.  Only if some of them
+        did not match is there one read of the tokens, which also tells a missing product from one
+        that is short on stock.  One update_many then pulls the tokens back off.  If the bulk_write
+        fails, the stock that it did take is put back with release_stock.
+        :param reservations:    A list of (product _id, quantity) tuples.
+        :return:                {position in reservations: reason} for every reservation that failed.
+        """
+        tokens_column = cls._fields['stockReservations'].db_field
+        batch = ObjectId()
+        tokens = {}  # token --> position in reservations
+        requests = []
+        failures = {}
+        for position, (product_id, quantity) in enumerate(reservations):
+            if product_id is None:
+                failures[position] = 'There is no such product.'
+                continue
+            token = f'{batch}:{position}'
+            tokens[token] = position
+            query, update = cls.stock_reservation(product_id, quantity)
+            update['$push'] = {tokens_column: token}
+            requests.append(UpdateOne(query, update))
+        if len(requests) == 0:
+            return failures
+        collection = cls._get_collection()
+        product_ids = list({reservations[position][0] for position in tokens.values()})
+
+        def taken() -> (set, set):
+            # The products that exist, and the positions whose token made it onto their product.
+            existing, matched = set(), set()
+            for product in collection.find({'_id': {'$in': product_ids}}, {tokens_column: 1}):
+                existing.add(product['_id'])
+                matched.update(tokens[token] for token in product.get(tokens_column, []) if token in tokens)
+            return existing, matched
+
+        def untag():
+            collection.update_many({'_id': {'$in': product_ids}, tokens_column: {'$in': list(tokens)}},
+                                   {'$pull': {tokens_column: {'$in': list(tokens)}}})
+        try:
+            result = collection.bulk_write(requests, ordered=False)
+        except Exception:
+            existing, matched = taken()
+            quantities = {}
+            for position in matched:
+                product_id, quantity = reservations[position]
+                quantities[product_id] = quantities.get(product_id, 0) + quantity
+            cls.release_stock(quantities)
+            untag()
+            raise
+        if result.matched_count < len(requests):
+            existing, matched = taken()
+            for position in tokens.values():
+                if position not in matched:
+                    failures[position] = 'Not enough in stock.' if reservations[position][0] in existing \
+                        else 'There is no such product.'
+        untag()
+        return failures
+
+    @classmethod
+    def stock_release_requests(cls, quantities: dict) -> [UpdateOne]:
+        """
+        Build the updates that put stock back, one $inc per product.
+        :param quantities:  {product _id: the quantity to put back}.
+        :return:            The list of UpdateOne requests for bulk_write.
+        """
+        stock = cls._fields['quantityInStock'].db_field
+        return [UpdateOne({'_id': product_id}, {'$inc': {stock: quantity}})
+                for product_id, quantity in quantities.items() if quantity]
+
+    @classmethod
+    def release_stock(cls, quantities: dict, session=None):
+        """
+        Put the stock of deleted or removed order items back, with one bulk_write.
+        :param quantities:  {product _id: the quantity to put back}.
+        :param session:     The session, if this is part of a transaction.
+        :return:            None
+        """
+        requests = cls.stock_release_requests(quantities)
+        if len(requests) > 0:
+            cls._get_collection().bulk_write(requests, ordered=False, session=session)
+
+    def read_only_check(self):
+        """
+        A product that came out of the cache is missing the fields that the cache leaves out, so
+        writing it back would lose them.  Read the product from the database to change it.
+        :raises OperationError: If this product came out of the cache.
+        """
+        if left_out(self):
+            raise OperationError(f'Product {self.productCode} came out of the cache without '
+                                 f'{", ".join(left_out(self))}, so it is read only.')
+
+    def save(self, *args, **kwargs):
+        # A product that is saved is no longer what the cache has, and the same goes for delete.
+        self.read_only_check()
+        result = super().save(*args, **kwargs)
+        invalidate(Product, self.pk)
+        return result
+
+    def update(self, **kwargs):
+        self.read_only_check()
+        result = super().update(**kwargs)
+        invalidate(Product, self.pk)
+        return result
+
+    def delete(self, *args, **kwargs):
+        product_id = self.pk
+        super().delete(*args, **kwargs)
+        invalidate(Product, product_id)
+
+
+# The products that order entry keeps looking up, by _id and by products_pk.  Each new order item
+# changes the stock, the stock reservations and the orderItems of its product, so those are not
+# cached, and everything in here that changes any other field of a product invalidates it.
+# Utilities.startup sizes the cache.
+product_cache = register_cache(DocumentCache(Product, 'products_pk',
+                                             exclude=['quantityInStock', 'orderItems', 'stockReservations']))
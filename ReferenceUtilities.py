@@ -0,0 +1,128 @@
+"""
+Created on 10/17/2026
+Utilities for working with ReferenceField values without making MongoEngine go out to the
+database for them.  Reading a ReferenceField attribute can dereference it, which is a query
+per access.  Most of the time all that we really want is the _id of the referenced document.
+"""
+from bson import DBRef
+
+
+def reference_id(value):
+    """
+    Return the _id of whatever a ReferenceField is holding at the moment.  Depending on how the
+    document was built or loaded, that could be the referenced Document itself, a DBRef, or just
+    the bare _id.
+    :param value:   The raw value of the reference, typically document._data[attribute name].
+    :return:        The _id of the referenced document, or None if there is no reference.
+    """
+    if value is None:
+        return None
+    elif isinstance(value, DBRef):
+        return value.id
+    elif hasattr(value, 'pk'):
+        return value.pk
+    else:
+        return value
+
+
+def forget_change(document, attribute_name: str):
+    """
+    Tell MongoEngine that an attribute has NOT changed, even though we modified it in memory.  We
+    do this after the same change has already been sent to the database as an atomic update, so
+    that a later save() does not send the entire attribute all over again.
+    :param document:        The Document instance that we modified.
+    :param attribute_name:  The name of the attribute to remove from the changed fields.
+    :return:                None
+    """
+    db_field = document._fields[attribute_name].db_field
+    document._changed_fields = [changed for changed in document._changed_fields
+                                if changed != db_field and not changed.startswith(db_field + '.')]
+
+
+class ItemIndex:
+    """
+    A dictionary that sits alongside a list of OrderItem references so that we can find an item
+    by key (the _id of the product or of the order) without walking the whole list and
+    dereferencing each element along the way.  The index remembers which list it was built from,
+    and how long that list was, so that it can tell when the list was replaced behind its back.
+    """
+    def __init__(self, items: list, key):
+        """
+        Build the index over a list of items.
+        :param items:   The list of OrderItem instances to index.
+        :param key:     A function that takes an OrderItem and returns its key in the index.
+        """
+        self.items = items
+        self.key = key
+        self.by_key = {}
+        for item in items:
+            self.by_key[key(item)] = item
+        self.size = len(items)
+
+    def covers(self, items: list) -> bool:
+        """
+        Check whether this index still describes the given list.
+        :param items:   The list that the document is holding right now.
+        :return:        True if the index can be used as is, False if it needs to be rebuilt.
+        """
+        return items is self.items and len(items) == self.size
+
+    def find(self, item):
+        """
+        Return the item in the list with the same key as the given item, if there is one.
+        :param item:    The OrderItem to look for.
+        :return:        The matching OrderItem in the list, or None.
+        """
+        return self.by_key.get(self.key(item))
+
+    def add(self, item):
+        """
+        Record an item that has just been appended to the list.
+        :param item:    The OrderItem that was appended.
+        :return:        None
+        """
+        self.by_key[self.key(item)] = item
+        self.size += 1
+
+    def position(self, item) -> int:
+        """
+        Find where an item that find returned sits in the list.  The list is searched for that very
+        object, so unlike list.remove or list.index, nothing is compared with == (which, for an
+        OrderItem, compares references that might have to be dereferenced).
+        :param item:    The OrderItem, as returned by find.
+        :return:        Its position in the list.
+        """
+        return next(position for position, element in enumerate(self.items) if element is item)
+
+    def remove(self, item):
+        """
+        Forget an item that has just been removed from the list.
+        :param item:    The OrderItem that was removed.
+        :return:        None
+        """
+        del self.by_key[self.key(item)]
+        self.size -= 1
+
+
+def reference_ids(document, attribute_name: str) -> list:
+    """
+    Return the _ids held in a list of references, without dereferencing any of them.
+    :param document:        The Document that has the list of references.
+    :param attribute_name:  The name of the ListField(ReferenceField) attribute.
+    :return:                The list of _ids, in the same order as the references.
+    """
+    return [reference_id(value) for value in (document._data.get(attribute_name) or [])]
+
+
+def fetch_by_ids(cls, ids: list, projection: dict) -> dict:
+    """
+    Read many documents of one class with a single $in query, as raw (pymongo) dictionaries.
+    :param cls:         The Document class whose collection we read from.
+    :param ids:         The _ids of the documents that we want.
+    :param projection:  The columns to bring back, in the pymongo projection format.
+    :return:            A dictionary of the documents found, keyed by _id.
+    """
+    if len(ids) == 0:
+        return {}
+    return {document['_id']: document
+            for document in cls._get_collection().find({'_id': {'$in': list(set(ids))}}, projection)}
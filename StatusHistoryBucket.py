@@ -0,0 +1,23 @@
+"""
+Created on 10/17/2026
+The older status changes of an order, once they no longer fit in the window of status history
+that stays embedded in the order.  See HistoryBucket.
+"""
+from mongoengine import *
+
+from HistoryBucket import HistoryBucket
+from StatusChange import StatusChange
+
+
+class StatusHistoryBucket(HistoryBucket):
+    """One month of status changes for one order, oldest first."""
+    OWNER = 'order'
+    DATE_ATTRIBUTE = 'statusChangeDate'
+
+    order = ReferenceField('Order', required=True)
+    entries = EmbeddedDocumentListField(StatusChange, db_field='entries')
+
+    meta = {'collection': 'status_history_buckets',
+            'indexes': [
+                {'unique': True, 'fields': ['order', 'bucketStart'], 'name': 'status_history_buckets_pk'}
+            ]}
@@ -0,0 +1,154 @@
+"""
+Created on 10/17/2026
+Connection set up for the application.  The settings come from an ini file (mongo_config.ini in
+the current directory, or wherever the MONGO_CONFIG environment variable points), with any of them
+overridden by an environment variable of the same name in upper case with a MONGO_ prefix.  For
+instance, max_pool_size in the file is overridden by MONGO_MAX_POOL_SIZE in the environment.
+
+    [mongodb]
+    uri = mongodb://localhost:27017
+    database = one_to_many
+    max_pool_size = 100
+    min_pool_size = 10
+    server_selection_timeout_ms = 5000
+    connect_timeout_ms = 5000
+    socket_timeout_ms = 30000
+    read_preference = primary
+    write_concern = majority
+    compressors = zstd,snappy,zlib
+    log_level = INFO
+    command_monitoring = true
+    product_cache_size = 1000
+    product_cache_ttl = 300
+    change_watcher = false
+"""
+import configparser
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from mongoengine import connect, ValidationError
+
+from CommandLogger import configure_logging, register_listeners
+from ConstraintUtilities import ensure_indexes, load_index_cache
+
+
+class Utilities:
+    """Starting up the connection to MongoDB, and reporting on the exceptions that come back from it."""
+
+    # The settings that we understand, with their defaults, and the type to convert them to.
+    DEFAULTS = {
+        'uri': ('mongodb://localhost:27017', str),
+        'database': ('one_to_many', str),
+        'max_pool_size': (100, int),
+        'min_pool_size': (0, int),
+        'server_selection_timeout_ms': (5000, int),
+        'connect_timeout_ms': (5000, int),
+        'socket_timeout_ms': (None, int),
+        'read_preference': ('primary', str),
+        'write_concern': (None, str),
+        'compressors': (None, str),
+        'log_level': (None, str),
+        'command_monitoring': (False, lambda value: str(value).strip().lower() in ('1', 'true', 'yes', 'on')),
+        'product_cache_size': (1000, int),
+        'product_cache_ttl': (300.0, float),
+        'change_watcher': (False, lambda value: str(value).strip().lower() in ('1', 'true', 'yes', 'on'))
+    }
+
+    # The ChangeWatcher that startup started, if the configuration asked for one.
+    watcher = None
+
+    @staticmethod
+    def load_config() -> dict:
+        """
+        Read the connection settings from the config file, then the environment.
+        :return:    A dictionary of every setting in DEFAULTS, converted to its type.
+        """
+        parser = configparser.ConfigParser()
+        parser.read(os.environ.get('MONGO_CONFIG', 'mongo_config.ini'))
+        section = parser['mongodb'] if parser.has_section('mongodb') else {}
+        config = {}
+        for name, (default, kind) in Utilities.DEFAULTS.items():
+            value = os.environ.get('MONGO_' + name.upper(), section.get(name, default))
+            config[name] = kind(value) if value is not None and value != '' else None
+        return config
+
+    @staticmethod
+    def startup(log_level=None):
+        """
+        Connect to MongoDB, warm up the connection pool, and build the indexes, so that none of that
+        is left for the first request to pay for.
+        :param log_level:   The logging level that the user picked, by name or number.  This is the
+                            only place that logging is configured, and a level given here wins over
+                            log_level in the environment (MONGO_LOG_LEVEL), which wins over the file.
+        :return:            The pymongo Database.
+        """
+        config = Utilities.load_config()
+        configure_logging(log_level if log_level is not None else config['log_level'])
+        if config['command_monitoring']:
+            register_listeners()  # This has to come before the client is created.
+        options = {'maxPoolSize': config['max_pool_size'],
+                   'minPoolSize': config['min_pool_size'],
+                   'serverSelectionTimeoutMS': config['server_selection_timeout_ms'],
+                   'connectTimeoutMS': config['connect_timeout_ms'],
+                   'socketTimeoutMS': config['socket_timeout_ms'],
+                   'readPreference': config['read_preference'],
+                   'w': int(config['write_concern']) if (config['write_concern'] or '').isdigit()
+                   else config['write_concern'],
+                   'compressors': config['compressors']}
+        client = connect(db=config['database'], host=config['uri'],
+                         **{option: value for option, value in options.items() if value is not None})
+        db = client[config['database']]
+        Utilities.warm_up(db, config['min_pool_size'])
+        # Imported here so that reading the configuration does not drag in all the models.
+        from Order import Order
+        from Product import Product
+        from OrderItem import OrderItem
+        from PriceHistoryBucket import PriceHistoryBucket
+        from StatusHistoryBucket import StatusHistoryBucket
+        classes = (Order, Product, OrderItem, PriceHistoryBucket, StatusHistoryBucket)
+        from Product import product_cache
+        for cls in classes:
+            ensure_indexes(cls)
+        load_index_cache(*classes)
+        # Orders stored before currentStatus existed get it filled in; after that this finds nothing.
+        Order.backfill_current_status()
+        product_cache.max_size = config['product_cache_size']
+        product_cache.ttl = config['product_cache_ttl']
+        if config['change_watcher']:
+            # Follow the changes that other processes make (this needs a replica set).
+            from ChangeWatcher import ChangeWatcher
+            Utilities.watcher = ChangeWatcher(db)
+            Utilities.watcher.start()
+        return db
+
+    @staticmethod
+    def warm_up(db, connections: int):
+        """
+        Open connections ahead of time by pinging the server from several threads at once.  Each
+        concurrent ping has to check out its own connection, so the pool ends up with at least that
+        many ready to use.
+        :param db:          The pymongo Database.
+        :param connections: How many connections to open.  At least one ping is always sent, which
+                            also makes sure that the server can be reached at all.
+        :return:            None
+        """
+        connections = max(1, connections or 0)
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            list(pool.map(lambda _: db.command('ping'), range(connections)))
+
+    @staticmethod
+    def print_exception(e: Exception) -> str:
+        """
+        Build a readable description of an exception from MongoEngine or pymongo.
+        :param e:   The exception.
+        :return:    The description, one line per problem.
+        """
+        if isinstance(e, ValidationError) and e.errors:
+            results = 'Validation errors:'
+            for field, error in e.to_dict().items():
+                results = results + '\n\t' + f'{field}: {error}'
+            return results
+        details = getattr(e, 'details', None)  # pymongo's OperationFailure carries the server's reply.
+        if details and details.get('errmsg'):
+            return f'{type(e).__name__}: {details["errmsg"]}'
+        return f'{type(e).__name__}: {e}'
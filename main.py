@@ -9,19 +9,23 @@ Code modified from sample:
 
 
 
-from ConstraintUtilities import select_general, unique_general, prompt_for_date
+from ConstraintUtilities import select_general, insert_unique, prompt_for_date
 from Utilities import Utilities
 from Order import Order
 from OrderItem import OrderItem
-from Product import Product
+from Product import Product, product_cache
 from PriceHistory import PriceHistory
+from CascadeUtilities import cascade_delete_product
 from StatusChange import StatusChange
-from CommandLogger import CommandLogger, log
-from pymongo import monitoring
+from CommandLogger import log, metrics, traced, register_listeners
 from Menu import Menu
 from Option import Option
-from menu_definitions import menu_main, add_select, list_select, select_select, delete_select, update_select
+from menu_definitions import menu_logging, menu_main, add_select, list_select, select_select, delete_select, \
+    update_select
 import CommonUtilities as CU  # Utilities that work for the sample code & the worked HW assignment.
+import BulkUtilities as BU  # Chunked loaders for when one prompt per document is too slow.
+from ListingUtilities import keyset_pages, index_columns, show_pages
+from ReferenceUtilities import fetch_by_ids, reference_id
 from _datetime import datetime
 
 """
@@ -33,6 +37,9 @@ it makes it impossible to remove OrderItem instances.  But you get the idea how
 
 # OrderItem.register_delete_rule(Order, 'orderItems', mongoengine.DENY)
 
+# The number of documents to show per page in the listings, and to bring back per round trip.
+LISTING_PAGE_SIZE: int = 25
+
 """
 Todo: 
     d.	Display an order.
@@ -42,6 +49,7 @@ Todo:
 
 """
 """***************METHODS FOR PRODUCT CLASS*****************"""
+@traced
 def add_product():
     """
     Adds a new document to the product collection. Protects user from entering a duplicate product
@@ -59,28 +67,40 @@ def add_product():
             input("Enter the msrp-->")
         )
 
-        # check for violated constraints
-        violated_constraints = unique_general(new_product)
+        # The first "price change" is the product being created which would be buy price
+        new_product.change_price(
+            PriceHistory(
+                buy_price,
+                datetime.now()
+            )
+        )
+        try:
+            # Straight to the insert, and let products_pk say whether this product is a duplicate.
+            violated_constraints = insert_unique(new_product)
+        except Exception as e:
+            print('Errors storing the new product:')
+            print(Utilities.print_exception(e))
+            continue
         if len(violated_constraints) > 0:
             for violated_constraint in violated_constraints:
                 print('Your input values violated constraint: ', violated_constraint)
             print('try again')
         else:
-            # The first "price change" is the product being created which would be buy price
-            new_product.change_price(
-                PriceHistory(
-                    buy_price,
-                    datetime.now()
-                )
-            )
-            try:
-                new_product.save()
-                success = True
-            except Exception as e:
-                print('Errors storing the new order:')
-                print(Utilities.print_exception(e))
+            success = True
 
 
+@traced
+def import_products():
+    """
+    Load a whole catalog of products from a CSV or JSONL file.  The column names in the file are the
+    column names in the products collection.  Rows that are invalid or that violate products_pk are
+    reported and skipped, the rest are inserted."""
+    file_name = input("Enter the name of the CSV or JSONL file-->")
+    chunk_size = int(input("Enter the number of rows to insert at a time-->"))
+    print(BU.import_products(file_name, chunk_size))
+
+
+@traced
 def update_product():
     """
     Change the price of an existing product. When changed we add to the PriceHistory
@@ -96,29 +116,43 @@ def update_product():
         product = select_product()  # Find a product to add new price
         price_change_date = prompt_for_date('Date and time of the price change: ')
         try:
-            product.change_price(PriceHistory(new_price, price_change_date))
-            product.save()
+            # Append the price change with an atomic $push rather than saving the entire product.
+            Product.push_price(product.pk, PriceHistory(new_price, price_change_date))
             success = True
         except ValueError as VE:
             print('Attempted status change failed because:')
             print(VE)
 
+@traced
 def delete_product():
     """Deletes a document from product collection. Doesnt allow user to delete a product not in database.
     Doesnt allow user to delete a product that is mentioned in any orders."""
-    product = select_product()  # prompt the user for an order to delete
-    items = product.orderItems  # retrieve the list of items in this order
-    for item in items:
-        # delete items before product delete, so mongo doesnt complain
-        item.delete()
-    # Now that all the items on the order are removed, we can safely remove the order itself.
-    product.delete()
+    product = select_product()  # prompt the user for a product to delete
+    # delete items before product delete, so mongo doesnt complain.  The cascade removes all the items
+    # at once and pulls them out of their orders, then removes the product itself.
+    print(cascade_delete_product(product))
 
 
 def select_product() -> Product:
     return select_general(Product)
 
+
+@traced
+def list_product():
+    """List all the products in products_pk order, a page at a time, with just the columns that we show."""
+    code, name, stock, history = [Product._fields[attribute].db_field for attribute in
+                                  ('productCode', 'productName', 'quantityInStock', 'priceHistory')]
+    price = PriceHistory._fields['newPrice'].db_field
+
+    def render(page):
+        return [f'Product code: {product.get(code)} Product Name: {product.get(name)} '
+                f'in stock: {product.get(stock)} current price: {(product.get(history) or [{}])[-1].get(price)}'
+                for product in page]
+    show_pages(keyset_pages(Product, {code: 1, name: 1, stock: 1, history: {'$slice': -1}},
+                            index_columns(Product, 'products_pk'), LISTING_PAGE_SIZE), render)
+
 """*****************METHODS FOR ORDERITEMS CLASS******************"""
+@traced
 def add_order_item():
     """
     Add an item to an existing order.
@@ -131,28 +165,44 @@ def add_order_item():
         order = select_order()  # Prompt the user for an order to operate on.
         # Create a new OrderItem instance.
         new_order_item = OrderItem(order,
-                                   input('Product Name --> '),
+                                   select_product(),
                                    int(input('Quantity --> ')))
-        # Make sure that this adheres to the existing uniqueness constraints.
-        # I COULD use print_exception after MongoEngine detects any uniqueness constraint violations, but
-        # MongoEngine will only report one uniqueness constraint violation at a time.  I want them all.
-        violated_constraints = unique_general(new_order_item)
+        product = new_order_item.product
+        try:
+            new_order_item.validate()
+            # Take the stock first.  The $inc only goes through if there are enough in stock, so
+            # there is no reading the stock level, checking it, and writing it back.
+            if not Product.reserve_stock(product.pk, new_order_item.quantity):
+                print(f'Sorry, there are not {new_order_item.quantity} of that product in stock.  Try again.')
+                continue
+        except Exception as e:
+            print('Exception trying to add the new item:')
+            print(Utilities.print_exception(e))
+            continue
+        # Insert first, and let order_items_pk catch a product that is already on the order.  That
+        # is one round trip instead of a check and then a save, and no one can sneak in between.
+        try:
+            violated_constraints = insert_unique(new_order_item)
+        except Exception as e:
+            violated_constraints = []
+            print('Exception trying to add the new item:')
+            print(Utilities.print_exception(e))
+        if new_order_item.pk is None:
+            # The item did not go in, so it gives its stock back.
+            Product.release_stock({product.pk: new_order_item.quantity})
         if len(violated_constraints) > 0:
             for violated_constraint in violated_constraints:
                 print('Your input values violated constraint: ', violated_constraint)
             print('Try again')
-        else:
-            try:
-                # we cannot add the OrderItem to the Order until it's been stored in the database.
-                new_order_item.save()
-                order.add_item(new_order_item)  # Add this OrderItem to the Order's MongoDB list of items.
-                order.save()  # Update the order in the database.
-                success = True  # Finally ready to call  it good.
-            except Exception as e:
-                print('Exception trying to add the new item:')
-                print(Utilities.print_exception(e))
+        elif new_order_item.pk is not None:
+            # Add the item to the orderItems lists of both the Order and the Product, without
+            # rewriting either of those documents.
+            BU.push_item_references(Order, [(order, new_order_item)])
+            BU.push_item_references(Product, [(product, new_order_item)])
+            success = True  # Finally ready to call  it good.
 
 
+@traced
 def delete_order_item():
     """
     Remove just one item from an existing order.
@@ -164,22 +214,82 @@ def delete_order_item():
     # Create an ad hoc menu of all of the items presently on the order.  Use __str__ to make a text version of each item
     for item in items:
         menu_items.append(Option(item.__str__(), item))
-    # prompt the user for which one of those order items to remove, and remove it.
-    order.remove_item(Menu('Item Menu',
-                           'Choose which order item to remove', menu_items).menu_prompt())
-    # Update the order to no longer include that order item in its MongoDB list of order items.
-    order.save()
+    # prompt the user for which one of those order items to remove, and remove it.  The atomic
+    # remove $pulls the item from the order's MongoDB list of order items, no need to save the order.
+    item = Menu('Item Menu', 'Choose which order item to remove', menu_items).menu_prompt()
+    order.remove_item(item, atomic=True)
+    # With nothing left pointing to it from the order, the OrderItem itself goes, along with the
+    # reference to it from its product, and its quantity goes back into stock.  Otherwise deleting
+    # the order later would find the item and put the same stock back a second time.
+    product_id = reference_id(item._data.get('product'))
+    OrderItem._get_collection().delete_one({'_id': item.pk})
+    Product._get_collection().update_one({'_id': product_id},
+                                         {'$pull': {Product._fields['orderItems'].db_field: item.pk}})
+    Product.release_stock({product_id: item.quantity})
 
 
 def select_order_item() -> OrderItem:
     return select_general(OrderItem)
 
 
+@traced
+def list_order_item():
+    """List all the order items, a page at a time.  The orders and products on each page are looked
+    up with one $in query each, rather than dereferencing them item by item."""
+    order_column, product_column, quantity = [OrderItem._fields[attribute].db_field for attribute in
+                                              ('order', 'product', 'quantity')]
+    customer, order_date = [Order._fields[attribute].db_field for attribute in ('customerName', 'orderDate')]
+    code, name = [Product._fields[attribute].db_field for attribute in ('productCode', 'productName')]
+
+    def render(page):
+        orders = fetch_by_ids(Order, [item[order_column] for item in page], {customer: 1, order_date: 1})
+        products = fetch_by_ids(Product, [item[product_column] for item in page], {code: 1, name: 1})
+        lines = []
+        for item in page:
+            order = orders.get(item[order_column], {})
+            product = products.get(item[product_column], {})
+            lines.append(f'OrderItem: Order placed by {order.get(customer)} on {order.get(order_date)} '
+                         f'Product: {product.get(code)} {product.get(name)}, Qty: {item.get(quantity)}')
+        return lines
+    show_pages(keyset_pages(OrderItem, {order_column: 1, product_column: 1, quantity: 1},
+                            page_size=LISTING_PAGE_SIZE), render)
+
+
 """*****************METHODS FOR ORDER CLASS******************"""
 def select_order() -> Order:
     return select_general(Order)
 
 
+@traced
+def list_order():
+    """List all the orders in orders_pk order, a page at a time, with just the columns that we show."""
+    customer, order_date, sold_by, history = [Order._fields[attribute].db_field for attribute in
+                                              ('customerName', 'orderDate', 'soldBy', 'statusHistory')]
+    status = StatusChange._fields['status'].db_field
+
+    def render(page):
+        return [f'Order: Placed by - {order.get(customer)} placed on {order.get(order_date)} '
+                f'sold by {order.get(sold_by)} status: {(order.get(history) or [{}])[-1].get(status)}'
+                for order in page]
+    show_pages(keyset_pages(Order, {customer: 1, order_date: 1, sold_by: 1, history: {'$slice': -1}},
+                            index_columns(Order, 'orders_pk'), LISTING_PAGE_SIZE), render)
+
+
+@traced
+def list_orders_in_status():
+    """List the orders that are currently in one status, longest in that status first, a page at a
+    time.  The orders_current_status index does the filtering and the sorting."""
+    status = prompt_for_enum('Which status:', StatusChange, 'status')
+    customer, order_date, sold_by, status_date = [Order._fields[attribute].db_field for attribute in
+                                                  ('customerName', 'orderDate', 'soldBy', 'currentStatusDate')]
+
+    def render(page):
+        return [f'Order: Placed by - {order.get(customer)} placed on {order.get(order_date)} '
+                f'sold by {order.get(sold_by)} {status.value} since {order.get(status_date)}'
+                for order in page]
+    show_pages(Order.orders_in_status(status, page_size=LISTING_PAGE_SIZE), render)
+
+
 def prompt_for_enum(prompt: str, cls, attribute_name: str):
     return CU.prompt_for_enum(prompt, cls, attribute_name)
 
@@ -230,11 +340,16 @@ def update():
 
 if __name__ == '__main__':
     print('Starting in main.')
-    monitoring.register(CommandLogger())
-    db = Utilities.startup()
+    log_level = menu_logging.menu_prompt()
+    register_listeners()
+    db = Utilities.startup(log_level)
     main_action: str = ''
     while main_action != menu_main.last_action():
         main_action = menu_main.menu_prompt()
         print('next action: ', main_action)
         exec(main_action)
+    log.info('MongoDB command metrics: %s', metrics.snapshot())
+    log.info('Product cache: %s', product_cache.stats())
+    if Utilities.watcher is not None:
+        Utilities.watcher.stop()
     log.info('All done for now.')
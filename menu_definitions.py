@@ -21,6 +21,7 @@ menu_main = Menu('main', 'Please select one of the following options:', [
 add_select = Menu('add select', 'Which type of object do you want to add?:', [
     Option("Orders", "add_order()"),
     Option("Products", "add_product()"),
+    Option("Products from a file", "import_products()"),
     Option("Order Items", "add_order_item()"),
     Option("Exit", "pass")
 ])
@@ -36,6 +37,7 @@ delete_select = Menu('delete select', 'Which type of object do you want to delet
 # options for listing the existing instances
 list_select = Menu('list select', 'Which type of object do you want to list?:', [
     Option("Orders", "list_order()"),
+    Option("Orders in a status", "list_orders_in_status()"),
     Option("Order Items", "list_order_item()"),
     Option("Products", "list_product()"),
     Option("Exit", "pass")